@@ -0,0 +1,62 @@
+import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None #Optional, the builtins work on arrays just fine, numpy is just faster for large windows
+
+#Every advertisement in a window gets folded into min/max/mean/count for these fields instead of only keeping the last one.
+aggregatedFields = ["temperature", "humidity", "pressure", "battery", "rssi"]
+#Samples buffered per field per tag before they are folded into the running totals. Keeps memory bounded no matter how chatty a tag is.
+maxBufferedSamples = 256
+
+class TagWindow:
+    __slots__ = ("buffers", "minimums", "maximums", "sums", "counts", "lastFields")
+
+    def __init__(self):
+        self.buffers = [array('d') for _ in aggregatedFields]
+        self.minimums = [math.inf] * len(aggregatedFields)
+        self.maximums = [-math.inf] * len(aggregatedFields)
+        self.sums = [0.0] * len(aggregatedFields)
+        self.counts = [0] * len(aggregatedFields)
+        self.lastFields = None
+
+    def add(self, fields:dict):
+        self.lastFields = fields
+        for index, name in enumerate(aggregatedFields):
+            value = fields.get(name)
+            if value == None:
+                continue
+            buffer = self.buffers[index]
+            buffer.append(value)
+            if len(buffer) >= maxBufferedSamples:
+                self.fold(index)
+
+    def fold(self, index:int):
+        buffer = self.buffers[index]
+        if not buffer:
+            return
+        if numpy != None:
+            values = numpy.frombuffer(buffer, dtype=numpy.float64)
+            low, high, total = float(values.min()), float(values.max()), float(values.sum())
+            del values #The array can't be resized while numpy still has a view of it
+        else:
+            low, high, total = min(buffer), max(buffer), math.fsum(buffer)
+        self.minimums[index] = min(self.minimums[index], low)
+        self.maximums[index] = max(self.maximums[index], high)
+        self.sums[index] += total
+        self.counts[index] += len(buffer)
+        del buffer[:]
+
+    #The last reading's fields, followed by <field>_min, <field>_max, <field>_mean and <field>_count for the whole window.
+    def summary(self)->dict:
+        summary = dict(self.lastFields)
+        for index, name in enumerate(aggregatedFields):
+            self.fold(index)
+            count = self.counts[index]
+            summary[f"{name}_min"] = self.minimums[index] if count else None
+            summary[f"{name}_max"] = self.maximums[index] if count else None
+            summary[f"{name}_mean"] = round(self.sums[index] / count, 3) if count else None
+            summary[f"{name}_count"] = count
+        return summary
@@ -0,0 +1,63 @@
+import asyncio
+
+import ConfigManager as config
+import EmailHandler
+from Log import log
+from RuuviPoller import RuuviData
+
+#Checks every advertisement against its tag's thresholds as it arrives so an alert goes out within seconds instead of at the next poll.
+#Emails are handed off to send_alerts() so polling never waits on them.
+
+dataHandlers = {} #mac -> DataHandler, owns the per tag email rate limiting. Set by main.
+digestWindowSec = 10 #In digest mode, wait this long after the first alert so everything else crossing at the same time goes in the same email
+
+thresholdsC:dict[str, tuple[float, float]] = {} #mac -> (lower, upper) in Celsius since that is what the tags report
+thresholdVersion = -1
+alertQueue = asyncio.Queue()
+pendingMacs = set() #Tags with an alert already queued
+
+def rebuild_thresholds():
+    global thresholdVersion
+    thresholdsC.clear()
+    for mac, cfg in config.tagConfigs.items():
+        if cfg.enabled and (cfg.lowerThresholdF != float("-inf") or cfg.upperThresholdF != float("inf")):
+            thresholdsC[mac] = ((cfg.lowerThresholdF - 32) / 1.8, (cfg.upperThresholdF - 32) / 1.8)
+    thresholdVersion = config.configVersion
+
+def on_advertisement(mac:str, data:RuuviData):
+    if thresholdVersion != config.configVersion:
+        rebuild_thresholds()
+
+    limits = thresholdsC.get(mac)
+    if limits == None or mac in pendingMacs:
+        return
+
+    temperatureC = data.temperature()
+    if temperatureC == None or limits[0] <= temperatureC <= limits[1]:
+        return
+
+    handler = dataHandlers.get(mac)
+    if handler == None or not handler.alert_due():
+        return
+
+    pendingMacs.add(mac)
+    alertQueue.put_nowait((mac, temperatureC))
+
+async def send_alerts():
+    while True:
+        alerts = [await alertQueue.get()]
+        if EmailHandler.digestMode:
+            await asyncio.sleep(digestWindowSec)
+        while not alertQueue.empty():
+            alerts.append(alertQueue.get_nowait())
+
+        for mac, temperatureC in alerts:
+            try:
+                cfg = config.tagConfigs.get(mac)
+                if cfg != None and cfg.enabled:
+                    dataHandlers[mac].check_and_queue_temperature_alert(temperatureC * 1.8 + 32, cfg)
+            except Exception as e:
+                log(f"send_alerts: {str(e)}")
+            finally:
+                pendingMacs.discard(mac)
+        await EmailHandler.send_digest()
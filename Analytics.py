@@ -0,0 +1,337 @@
+import argparse
+import glob
+import json
+import math
+import os
+import sys
+import time
+from datetime import date, timedelta
+from itertools import islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None #Optional, same results either way. numpy just gets through a multi year archive a lot quicker.
+
+import Compression
+import ConfigManager as config
+
+#Statistics over the CSVs DataHandler writes to data/. Files are streamed chunkRows lines at a time so memory stays bounded on a Pi.
+#  python Analytics.py                          -> Weekly summary of every sensor
+#  python Analytics.py --period day --sensor X  -> Daily summary of sensors whose name contains X
+#  python Analytics.py --json                   -> Everything (Including each gap) as json
+#Temperatures are in F, same as the CSVs. Time outside thresholds uses each tag's thresholds from the local config.
+#  python Analytics.py --compression swinging_door -> For CSVs logged with main.compressionMethod on (Give --heartbeat-sec too if
+#                                                     compressionHeartbeatSec isn't the default). Rows are up to the heartbeat apart
+#                                                     on purpose then, and swinging door rows are joined with straight lines.
+
+scriptDir = os.path.dirname(os.path.realpath(__file__))
+dataDir = scriptDir + "/data"
+chunkRows = 100000
+gapMinutes = 30 #Silence longer than this counts as a gap, and isn't counted towards time outside thresholds or degree-days
+degreeDayBaseF = 50 #Growing degree-days base temperature
+compression = None #main.compressionMethod the CSVs were logged with
+heartbeatSec = Compression.heartbeatSec #main.compressionHeartbeatSec the CSVs were logged with
+
+#Per day running totals, indexed by these
+MIN, MAX, SUM, COUNT, OUTSIDE_SEC, DEGREE_DAYS, COVERED_SEC = range(7)
+
+offsetCache:dict[int, int] = {} #Quarter hours since the epoch -> UTC offset (Seconds) in effect
+
+#Every UTC offset, and so every DST change, falls on a quarter hour, so the offset at the start of one holds for all of it
+def utc_offset(timestamp:float):
+    quarterHour = int(timestamp // 900)
+    offset = offsetCache.get(quarterHour)
+    if offset == None:
+        offset = offsetCache[quarterHour] = time.localtime(quarterHour * 900).tm_gmtoff
+    return offset
+
+#Days since the epoch, local time
+def local_day(timestamp:float):
+    return int((timestamp + utc_offset(timestamp)) // 86400)
+
+#Compressed rows can be a whole heartbeat apart without the tag going quiet
+def gap_limit_sec():
+    if compression == None:
+        return gapMinutes * 60
+    return heartbeatSec + gapMinutes * 60
+
+#Swinging door drops rows that lie within tolerance of the line between the rows around them, so that line is the best guess for
+#the time in between. Otherwise each reading's value is held until the next one.
+def interpolating():
+    return compression == "swinging_door"
+
+#Fraction of the straight line from a to b which is above x
+def fraction_above(a:float, b:float, x:float):
+    if (a > x) == (b > x):
+        return 1.0 if a > x else 0.0
+    crossing = (x - a) / (b - a)
+    return 1 - crossing if b > x else crossing
+
+#Average of max(value - x, 0) along the straight line from a to b
+def mean_above(a:float, b:float, x:float):
+    if a >= x and b >= x:
+        return (a + b) / 2 - x
+    if a <= x and b <= x:
+        return 0.0
+    return fraction_above(a, b, x) * (max(a, b) - x) / 2
+
+def fraction_above_numpy(a, b, x:float):
+    aAbove, bAbove = a > x, b > x
+    crossing = (x - a) / (b - a)
+    return numpy.where(aAbove == bAbove, aAbove.astype(numpy.float64), numpy.where(bAbove, 1 - crossing, crossing))
+
+def mean_above_numpy(a, b, x:float):
+    partly = fraction_above_numpy(a, b, x) * (numpy.maximum(a, b) - x) / 2
+    return numpy.where((a >= x) & (b >= x), (a + b) / 2 - x, numpy.where((a <= x) & (b <= x), 0.0, partly))
+
+def local_days_numpy(timestamps):
+    quarterHours, inverse = numpy.unique(numpy.floor(timestamps / 900).astype(numpy.int64), return_inverse=True)
+    offsets = numpy.array([utc_offset(quarterHour * 900) for quarterHour in quarterHours.tolist()], dtype=numpy.float64)
+    return numpy.floor((timestamps + offsets[inverse]) / 86400).astype(numpy.int64)
+
+class SensorStats:
+    def __init__(self, sensorId:str, lowerF:float, upperF:float):
+        self.sensorId = sensorId
+        self.lowerF = lowerF
+        self.upperF = upperF
+        self.days:dict[int, list] = {} #Days since the epoch (Local time) -> running totals
+        self.gaps:list[tuple[float, float]] = [] #(Last reading before, first reading after)
+        self.lastTimestamp = None
+        self.lastTemperature = math.nan
+        self.rows = 0
+
+    def day_totals(self, day:int):
+        totals = self.days.get(day)
+        if totals == None:
+            totals = self.days[day] = [math.inf, -math.inf, 0.0, 0, 0.0, 0.0, 0.0]
+        return totals
+
+    #The interval after a reading belongs to it (And to its day). Its value is held until the next reading, or joined to it with a
+    #straight line when interpolating().
+    def add_chunk_numpy(self, timestamps, temperatures):
+        self.rows += len(timestamps)
+        days = local_days_numpy(timestamps)
+
+        known = ~numpy.isnan(temperatures)
+        if known.any():
+            keys, inverse = numpy.unique(days[known], return_inverse=True)
+            knownTemperatures = temperatures[known]
+            minimums = numpy.full(len(keys), numpy.inf)
+            maximums = numpy.full(len(keys), -numpy.inf)
+            numpy.minimum.at(minimums, inverse, knownTemperatures)
+            numpy.maximum.at(maximums, inverse, knownTemperatures)
+            sums = numpy.bincount(inverse, weights=knownTemperatures, minlength=len(keys))
+            counts = numpy.bincount(inverse, minlength=len(keys))
+            for i, day in enumerate(keys.tolist()):
+                totals = self.day_totals(day)
+                totals[MIN] = min(totals[MIN], minimums[i])
+                totals[MAX] = max(totals[MAX], maximums[i])
+                totals[SUM] += sums[i]
+                totals[COUNT] += int(counts[i])
+
+        if self.lastTimestamp == None:
+            starts, startTemperatures, startDays = timestamps[:-1], temperatures[:-1], days[:-1]
+            endTemperatures = temperatures[1:]
+            intervals = numpy.diff(timestamps)
+        else:
+            starts = numpy.concatenate(([self.lastTimestamp], timestamps[:-1]))
+            startTemperatures = numpy.concatenate(([self.lastTemperature], temperatures[:-1]))
+            startDays = local_days_numpy(starts)
+            endTemperatures = temperatures
+            intervals = timestamps - starts
+        self.lastTimestamp = float(timestamps[-1])
+        self.lastTemperature = float(temperatures[-1])
+        if not len(intervals):
+            return
+
+        gapMask = intervals > gap_limit_sec()
+        for index in numpy.nonzero(gapMask)[0].tolist():
+            self.gaps.append((float(starts[index]), float(starts[index] + intervals[index])))
+        covered = numpy.where(gapMask | (intervals < 0) | numpy.isnan(startTemperatures), 0.0, intervals)
+        if interpolating():
+            endTemperatures = numpy.where(numpy.isnan(endTemperatures), startTemperatures, endTemperatures)
+        else:
+            endTemperatures = startTemperatures
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            outsideFraction = fraction_above_numpy(startTemperatures, endTemperatures, self.upperF) + fraction_above_numpy(-startTemperatures, -endTemperatures, -self.lowerF)
+            outside = numpy.where(covered > 0, outsideFraction * covered, 0.0)
+            degreeDays = numpy.where(covered > 0, mean_above_numpy(startTemperatures, endTemperatures, degreeDayBaseF) * covered / 86400, 0.0)
+
+        keys, inverse = numpy.unique(startDays, return_inverse=True)
+        coveredSums = numpy.bincount(inverse, weights=covered, minlength=len(keys))
+        outsideSums = numpy.bincount(inverse, weights=outside, minlength=len(keys))
+        degreeDaySums = numpy.bincount(inverse, weights=degreeDays, minlength=len(keys))
+        for i, day in enumerate(keys.tolist()):
+            totals = self.day_totals(day)
+            totals[COVERED_SEC] += coveredSums[i]
+            totals[OUTSIDE_SEC] += outsideSums[i]
+            totals[DEGREE_DAYS] += degreeDaySums[i]
+
+    def add_chunk_python(self, timestamps:list[float], temperatures:list[float]):
+        self.rows += len(timestamps)
+        for timestamp, temperature in zip(timestamps, temperatures):
+            if self.lastTimestamp != None:
+                interval = timestamp - self.lastTimestamp
+                totals = self.day_totals(local_day(self.lastTimestamp))
+                if interval > gap_limit_sec():
+                    self.gaps.append((self.lastTimestamp, timestamp))
+                elif interval > 0 and not math.isnan(self.lastTemperature):
+                    endTemperature = temperature if interpolating() and not math.isnan(temperature) else self.lastTemperature
+                    totals[COVERED_SEC] += interval
+                    outsideFraction = fraction_above(self.lastTemperature, endTemperature, self.upperF) + fraction_above(-self.lastTemperature, -endTemperature, -self.lowerF)
+                    totals[OUTSIDE_SEC] += outsideFraction * interval
+                    totals[DEGREE_DAYS] += mean_above(self.lastTemperature, endTemperature, degreeDayBaseF) * interval / 86400
+            self.lastTimestamp = timestamp
+            self.lastTemperature = temperature
+            if not math.isnan(temperature):
+                totals = self.day_totals(local_day(timestamp))
+                totals[MIN] = min(totals[MIN], temperature)
+                totals[MAX] = max(totals[MAX], temperature)
+                totals[SUM] += temperature
+                totals[COUNT] += 1
+
+def to_float(value:str):
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan #"None" when the tag didn't send a value
+
+#Older files are the ones HistoryWriter moved aside when the columns changed (name_data_20240101120000.csv)
+def sensor_files(sensorFilter:str):
+    sensors:dict[str, list[str]] = {}
+    for path in sorted(glob.glob(f"{dataDir}/*_data*.csv")):
+        sensorId = os.path.basename(path).rsplit("_data", 1)[0]
+        if sensorFilter and sensorFilter.lower() not in sensorId.lower():
+            continue
+        sensors.setdefault(sensorId, []).append(path)
+    for paths in sensors.values():
+        paths.sort(key=lambda path: (path.endswith("_data.csv"), path)) #Oldest first, the current file comes last
+    return sensors
+
+def read_chunks(path:str):
+    with open(path, 'r') as dataFile:
+        header = dataFile.readline().strip().split(",")
+        if "timestamp" not in header or "temperature" not in header:
+            return
+        timestampCol, temperatureCol = header.index("timestamp"), header.index("temperature")
+        while True:
+            lines = list(islice(dataFile, chunkRows))
+            if not lines:
+                return
+            if numpy != None:
+                try:
+                    columns = numpy.loadtxt(lines, delimiter=",", usecols=(timestampCol, temperatureCol), dtype=numpy.float64, ndmin=2)
+                    yield columns[:, 0], columns[:, 1]
+                    continue
+                except ValueError:
+                    pass #Missing values ("None") somewhere in this chunk, take the slow way
+            rows = [line.rstrip("\n").split(",") for line in lines]
+            rows = [row for row in rows if len(row) > max(timestampCol, temperatureCol)]
+            if not rows:
+                continue
+            timestamps = [to_float(row[timestampCol]) for row in rows]
+            temperatures = [to_float(row[temperatureCol]) for row in rows]
+            if numpy != None:
+                yield numpy.array(timestamps), numpy.array(temperatures)
+            else:
+                yield timestamps, temperatures
+
+def sensor_thresholds():
+    config.load_local_file()
+    thresholds = {}
+    for mac, cfg in config.tagConfigs.items():
+        thresholds[cfg.name + "(" + ''.join(mac.split(":")[-2:]) + ")"] = (cfg.lowerThresholdF, cfg.upperThresholdF)
+    return thresholds
+
+def analyze(sensorFilter:str = None):
+    thresholds = sensor_thresholds()
+    results = []
+    for sensorId, paths in sensor_files(sensorFilter).items():
+        stats = SensorStats(sensorId, *thresholds.get(sensorId, (-math.inf, math.inf)))
+        for path in paths:
+            for timestamps, temperatures in read_chunks(path):
+                if numpy != None:
+                    stats.add_chunk_numpy(timestamps, temperatures)
+                else:
+                    stats.add_chunk_python(timestamps, temperatures)
+        results.append(stats)
+    return results
+
+def period_key(day:int, period:str):
+    day = date(1970, 1, 1) + timedelta(days=day)
+    if period == "week":
+        year, week, _ = day.isocalendar()
+        return f"{year}-W{week:02d}"
+    return day.isoformat()
+
+def summarize(stats:SensorStats, period:str):
+    periods:dict[str, list] = {}
+    for day in sorted(stats.days):
+        dayTotals = stats.days[day]
+        key = period_key(day, period)
+        totals = periods.get(key)
+        if totals == None:
+            periods[key] = list(dayTotals)
+            continue
+        totals[MIN] = min(totals[MIN], dayTotals[MIN])
+        totals[MAX] = max(totals[MAX], dayTotals[MAX])
+        for index in (SUM, COUNT, OUTSIDE_SEC, DEGREE_DAYS, COVERED_SEC):
+            totals[index] += dayTotals[index]
+    return {key: {
+        "minF": round(totals[MIN], 2) if totals[COUNT] else None,
+        "maxF": round(totals[MAX], 2) if totals[COUNT] else None,
+        "meanF": round(totals[SUM] / totals[COUNT], 2) if totals[COUNT] else None,
+        "readings": totals[COUNT],
+        "outsideThresholdsHr": round(totals[OUTSIDE_SEC] / 3600, 2),
+        "growingDegreeDays": round(totals[DEGREE_DAYS], 2),
+        "coveredHr": round(totals[COVERED_SEC] / 3600, 2),
+    } for key, totals in periods.items()}
+
+def format_time(timestamp:float):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+
+def print_report(results:list[SensorStats], period:str):
+    for stats in results:
+        print(f"\n== {stats.sensorId} ({stats.rows} readings, thresholds {stats.lowerF}F to {stats.upperF}F) ==")
+        print(f"{period:<10} {'min':>7} {'max':>7} {'mean':>7} {'outside(h)':>11} {'GDD':>7} {'covered(h)':>11}")
+        for key, summary in summarize(stats, period).items():
+            print(f"{key:<10} {str(summary['minF']):>7} {str(summary['maxF']):>7} {str(summary['meanF']):>7} {summary['outsideThresholdsHr']:>11} {summary['growingDegreeDays']:>7} {summary['coveredHr']:>11}")
+        totalGapHr = sum(end - start for start, end in stats.gaps) / 3600
+        print(f"{len(stats.gaps)} gaps longer than {gap_limit_sec() / 60:g} minutes, {totalGapHr:.1f} hours silent in total")
+        for start, end in sorted(stats.gaps, key=lambda gap: gap[1] - gap[0], reverse=True)[:5]:
+            print(f"  {format_time(start)} -> {format_time(end)} ({(end - start) / 3600:.1f}h)")
+
+def to_json(results:list[SensorStats], period:str):
+    return {stats.sensorId: {
+        "readings": stats.rows,
+        "lowerThresholdF": stats.lowerF if math.isfinite(stats.lowerF) else None,
+        "upperThresholdF": stats.upperF if math.isfinite(stats.upperF) else None,
+        "periods": summarize(stats, period),
+        "gaps": [{"start": start, "end": end, "minutes": round((end - start) / 60, 1)} for start, end in stats.gaps],
+    } for stats in results}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the local CSV history of every RuuviTag")
+    parser.add_argument("--period", choices=["day", "week"], default="week")
+    parser.add_argument("--sensor", default=None, help="Only sensors whose name contains this")
+    parser.add_argument("--data-dir", default=dataDir)
+    parser.add_argument("--gap-minutes", type=float, default=gapMinutes)
+    parser.add_argument("--gdd-base", type=float, default=degreeDayBaseF, help="Growing degree-days base temperature (F)")
+    parser.add_argument("--compression", choices=["deadband", "swinging_door"], default=None, help="How the CSVs were compressed (main.compressionMethod)")
+    parser.add_argument("--heartbeat-sec", type=float, default=heartbeatSec, help="main.compressionHeartbeatSec the CSVs were logged with")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    dataDir = args.data_dir
+    gapMinutes = args.gap_minutes
+    degreeDayBaseF = args.gdd_base
+    compression = args.compression
+    heartbeatSec = args.heartbeat_sec
+
+    startTime = time.perf_counter()
+    results = analyze(args.sensor)
+    if args.json:
+        print(json.dumps(to_json(results, args.period), indent=1))
+    else:
+        print_report(results, args.period)
+        print(f"\n{sum(stats.rows for stats in results)} readings from {len(results)} sensors in {time.perf_counter() - startTime:.2f}s", file=sys.stderr)
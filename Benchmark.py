@@ -0,0 +1,377 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+#End to end benchmark. Synthesizes RuuviTag advertisements straight into RuuviPoller.polltags and swaps the Google services
+#for an in process fake with adjustable latency and errors, so the full handle_tag_data/upload path can be timed without tags or an account.
+#  python Benchmark.py                         -> Runs the standard scenarios (10, 100, 1000 tags and a network outage)
+#  python Benchmark.py --tags 50 --cycles 10   -> Runs one custom scenario
+#Each scenario runs in its own process so module state (config, outbox, caches) starts fresh.
+
+scriptDir = os.path.dirname(os.path.realpath(__file__))
+
+standardScenarios = {
+    "10 tags": ["--tags", "10"],
+    "100 tags": ["--tags", "100"],
+    "1000 tags": ["--tags", "1000"],
+    "outage": ["--tags", "100", "--cycles", "8", "--outage", "2-5"],
+}
+
+class FakeRequest:
+    def __init__(self, google, name, func):
+        self.google = google
+        self.name = name
+        self.func = func
+
+    def execute(self):
+        self.google.before_call(self.name)
+        return self.func()
+
+class FakeBatch:
+    def __init__(self, google, callback):
+        self.google = google
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.google.before_call("sheets.batch")
+        for requestId, request in self.requests:
+            self.google.calls[request.name + "(batched)"] += 1
+            try:
+                self.callback(requestId, request.func(), None)
+            except Exception as e:
+                self.callback(requestId, None, e)
+
+#Just enough of the drive/oauth2/gmail services for GAPIHelper, plus the files they all share. Everything is chained the same way
+#as googleapiclient (service.files().list(...).execute()) so GAPIHelper can't tell the difference.
+class FakeGoogle:
+    def __init__(self, latencySec:float, errorRate:float):
+        self.latencySec = latencySec
+        self.errorRate = errorRate
+        self.outage = False
+        self.calls = Counter()
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def before_call(self, name:str):
+        with self.lock:
+            self.calls[name] += 1
+        time.sleep(self.latencySec)
+        if self.outage or random.random() < self.errorRate:
+            with self.lock:
+                self.calls["errors"] += 1
+            raise(ConnectionError(f"Simulated network failure during {name}"))
+
+    def not_found(self, fileId):
+        from googleapiclient.errors import HttpError
+        import httplib2
+        return HttpError(httplib2.Response({"status": 404}), f"File {fileId} not found".encode())
+
+    def get_file(self, fileId):
+        if fileId not in self.objects:
+            raise(self.not_found(fileId))
+        return self.objects[fileId]
+
+    def add_file(self, name, mimeType, parent, values=None):
+        fileId = f"fake{len(self.objects)}"
+        self.objects[fileId] = {"name": name, "mimeType": mimeType, "parent": parent, "values": values or [], "version": 1}
+        return fileId
+
+    #Drive
+    def files(self):
+        return self
+
+    def list(self, q, fields):
+        name, mimeType, parent = re.match(r"name = '(.*)' and mimeType = '(.*)' and '(.*)' in parents", q).groups()
+        def run():
+            found = [{"id": fileId, "name": f["name"]} for fileId, f in self.objects.items() if (f["name"], f["mimeType"], f["parent"]) == (name, mimeType, parent)]
+            return {"files": found}
+        return FakeRequest(self, "drive.files.list", run)
+
+    def create(self, body, fields):
+        return FakeRequest(self, "drive.files.create", lambda: {"id": self.add_file(body["name"], body["mimeType"], body["parents"][0])})
+
+    def get(self, fileId=None, fields=None):
+        if fileId == None:
+            return FakeRequest(self, "oauth2.userinfo.get", lambda: {"email": "benchmark@example.com"}) #userinfo().get()
+        def run():
+            f = self.get_file(fileId)
+            return {"version": str(f["version"]), "modifiedTime": str(f["version"])}
+        return FakeRequest(self, "drive.files.get", run)
+
+    def update(self, fileId, body, media_body):
+        def run():
+            self.get_file(fileId)["version"] += 1
+            return {"id": fileId, "name": body["name"]}
+        return FakeRequest(self, "drive.files.update", run)
+
+    #OAuth2/Gmail
+    def userinfo(self):
+        return self
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def send(self, userId, body):
+        return FakeRequest(self, "gmail.messages.send", lambda: {"id": "fakeMessage"})
+
+class FakeSheets:
+    def __init__(self, google:FakeGoogle):
+        self.google = google
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, spreadsheetId, range):
+        def run():
+            values = self.google.get_file(spreadsheetId)["values"]
+            return {"values": values} if values else {}
+        return FakeRequest(self.google, "sheets.values.get", run)
+
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        def run():
+            f = self.google.get_file(spreadsheetId)
+            f["values"] = [list(row) for row in body["values"]]
+            f["version"] += 1
+            return {"updatedCells": sum(len(row) for row in body["values"])}
+        return FakeRequest(self.google, "sheets.values.update", run)
+
+    def append(self, spreadsheetId, range, valueInputOption, insertDataOption, body):
+        def run():
+            f = self.google.get_file(spreadsheetId)
+            f["values"].extend(body["values"])
+            f["version"] += 1
+            return {"updates": {"updatedRows": len(body["values"])}}
+        return FakeRequest(self.google, "sheets.values.append", run)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self.google, callback)
+
+class FakeCredentials:
+    valid = True
+    expired = False
+    expiry = None
+    refresh_token = "fake"
+
+    def to_json(self):
+        return "{}"
+
+def make_payload(temperatureC:float, sequence:int, rssi:int, macBytes:bytes, layout):
+    power = ((3000 - 1600) << 5) | 20
+    raw = layout.pack(5, int(temperatureC * 200), int(50 * 400), 101325 - 50000, 0, 0, 1000, power, 0, sequence % 0xFFFF, macBytes)
+    return raw.hex() + f"{rssi & 0xFF:02x}"
+
+#Produces advertisements at the requested rate into a bounded queue, like a BLE adapter would. Anything that doesn't fit is dropped.
+class TagSimulator:
+    def __init__(self, macs:list[str], advertsPerTagSec:float, queueSize:int):
+        self.macs = macs
+        self.advertsPerTagSec = advertsPerTagSec
+        self.queue = asyncio.Queue(maxsize=queueSize)
+        self.generated = 0
+        self.dropped = 0
+
+    async def produce(self, ruuvi):
+        tickSec = 0.05
+        owed = 0.0
+        sequence = 0
+        start = time.monotonic()
+        while True:
+            await asyncio.sleep(tickSec)
+            owed += len(self.macs) * self.advertsPerTagSec * tickSec
+            while owed >= 1:
+                owed -= 1
+                mac = self.macs[self.generated % len(self.macs)]
+                sequence += 1
+                temperatureC = 20 + 5 * math.sin((time.monotonic() - start) / 60 + self.generated % len(self.macs))
+                payload = make_payload(temperatureC, sequence, random.randint(-95, -40), bytes.fromhex(mac.replace(":", "")), ruuvi.Df5Reading.layout)
+                self.generated += 1
+                try:
+                    self.queue.put_nowait((mac, ruuvi.Df5Reading(payload)))
+                except asyncio.QueueFull:
+                    self.dropped += 1
+
+    async def scan_tags(self, whitelist):
+        while True:
+            yield await self.queue.get()
+
+def percentile(values:list[float], pct:float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+async def run_scenario(args):
+    startupStart = time.perf_counter()
+    workDir = tempfile.mkdtemp(prefix="ruuvi_benchmark_")
+
+    #Everything that touches the disk gets pointed at workDir before main is imported (main does its startup on import)
+    import Log
+    Log.logFilePath = workDir + "/ErrorLogs.txt"
+    Log.recentEntries.clear()
+    import GAPIHelper
+    GAPIHelper.change_id_cache_location(workDir + "/DriveIdCache.json")
+    import ConfigManager
+    ConfigManager.scriptDir = workDir
+    import DataHandler
+    DataHandler.scriptDir = workDir
+    import Outbox
+    Outbox.outboxPath = workDir + "/Outbox.db"
+    import SheetPartitions
+    SheetPartitions.indexPath = workDir + "/SheetPartitions.json"
+    import EmailHandler
+    import RuuviPoller as ruuvi
+
+    google = FakeGoogle(args.latency, args.error_rate)
+    GAPIHelper.userToken = FakeCredentials()
+    GAPIHelper.services.update({"drive": google, "sheets": FakeSheets(google), "oauth2": google, "gmail": google})
+    def slow_sign_in():
+        time.sleep(args.auth_latency) #Stands in for the token refresh/consent a real start waits on
+        return True
+    GAPIHelper.get_valid_token = slow_sign_in
+
+    macs = [f"BE:0C:00:00:{i // 256:02X}:{i % 256:02X}" for i in range(args.tags)]
+    configFolderId = google.add_file("config", GAPIHelper.obj.folder.value, "root")
+    configRows = [ConfigManager.configFileHeaders.strip().split(",")] + [[mac, f"Tag{i}", "40", "95", "True"] for i, mac in enumerate(macs)]
+    google.add_file("RuuviConfig", GAPIHelper.obj.sheet.value, configFolderId, configRows)
+
+    simulator = TagSimulator(macs, args.rate, args.queue_size)
+    ruuvi.scan_tags = simulator.scan_tags
+    ingested = Counter()
+    startup = {}
+    def on_advertisement(mac, data):
+        ingested.update(("adverts",))
+        startup.setdefault("firstAdvertSec", round(time.perf_counter() - startupStart, 4))
+    ruuvi.advertisementSubscribers.append(on_advertisement)
+
+    importStart = time.perf_counter()
+    import main
+    importSec = time.perf_counter() - importStart
+    main.TimeoutMonitor.startTime = time.time()
+    for mac in macs:
+        main.TimeoutMonitor.track(mac)
+    EmailHandler.debugOnly = True #main sets this from its own config on import
+    SheetPartitions.partitionMode = args.partition_mode
+    main.Compression.method = args.compression
+    SheetPartitions.partitionMaxRows = args.partition_rows
+    main.uploadRetryDelaySec = 0 #Cycles are seconds apart here, retry the uploads on every one
+
+    async def sign_in():
+        await main.GAPIAsync.acquire_token()
+        startup["tokenReadySec"] = round(time.perf_counter() - startupStart, 4)
+    tasks = [asyncio.create_task(simulator.produce(ruuvi)), asyncio.create_task(ruuvi.polltags([])), asyncio.create_task(sign_in()), asyncio.create_task(main.AlertMonitor.send_alerts()), asyncio.create_task(main.TimeoutMonitor.watch_timeouts())]
+    outageStart, outageEnd = (int(cycle) for cycle in args.outage.split("-")) if args.outage else (-1, -1)
+
+    cycles = []
+    runStart = time.monotonic()
+    for cycle in range(args.cycles):
+        await asyncio.sleep(args.cycle_sec)
+        google.outage = outageStart <= cycle <= outageEnd
+        callsBefore = sum(google.calls.values())
+        cycleStart = time.perf_counter()
+        error = None
+        tagData = {}
+        try:
+            tagData = await ruuvi.getLatestData()
+            await main.handle_tag_data(tagData)
+        except Exception as e:
+            error = str(e)
+        cycles.append({
+            "cycle": cycle,
+            "latencySec": round(time.perf_counter() - cycleStart, 4),
+            "tagsReported": len(tagData),
+            "apiCalls": sum(google.calls.values()) - callsBefore,
+            "outboxPending": Outbox.pending_count(),
+            "outage": google.outage,
+            "error": error,
+        })
+
+    for task in tasks:
+        task.cancel()
+    main.flush_held_readings()
+    main.HistoryWriter.close()
+
+    latencies = [cycle["latencySec"] for cycle in cycles]
+    elapsed = time.monotonic() - runStart
+    return {
+        "tags": args.tags,
+        "advertsPerTagSec": args.rate,
+        "importSec": round(importSec, 4),
+        "startup": startup,
+        "cycleLatencySec": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "max": max(latencies)},
+        "advertsGenerated": simulator.generated,
+        "advertsIngested": ingested["adverts"],
+        "advertsDropped": simulator.dropped,
+        "ingestPerSec": round(ingested["adverts"] / elapsed, 1),
+        "apiCalls": dict(google.calls),
+        "outboxPendingAtEnd": Outbox.pending_count(),
+        "rowsLogged": main.Compression.rowsKept if args.compression else main.Compression.rowsIn,
+        "readingsHandled": main.Compression.rowsIn,
+        "cycles": cycles,
+    }
+
+def print_report(name:str, result:dict):
+    latency = result["cycleLatencySec"]
+    print(f"\n== {name} ==")
+    print(f"Startup (s): main imported in {result['importSec']}, first advertisement at {result['startup'].get('firstAdvertSec')}, token ready at {result['startup'].get('tokenReadySec')}")
+    print(f"Cycle latency (s): p50 {latency['p50']}  p95 {latency['p95']}  max {latency['max']}")
+    print(f"Adverts: {result['advertsGenerated']} generated, {result['advertsIngested']} ingested, {result['advertsDropped']} dropped ({result['ingestPerSec']}/s)")
+    print(f"API calls: {sum(count for call, count in result['apiCalls'].items() if call != 'errors')} ({result['apiCalls'].get('errors', 0)} failed) {json.dumps(result['apiCalls'])}")
+    print(f"Outbox rows still pending: {result['outboxPendingAtEnd']}")
+    print(f"Rows logged: {result['rowsLogged']} of {result['readingsHandled']} readings")
+    for cycle in result["cycles"]:
+        print(f"  cycle {cycle['cycle']}: {cycle['latencySec']}s, {cycle['tagsReported']} tags, {cycle['apiCalls']} calls, {cycle['outboxPending']} pending" + (" [outage]" if cycle["outage"] else "") + (f" error: {cycle['error']}" if cycle["error"] else ""))
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the RuuviTag alerter against simulated tags and a fake Google API")
+    parser.add_argument("--tags", type=int, default=None, help="Number of simulated tags")
+    parser.add_argument("--rate", type=float, default=1.0, help="Advertisements per tag per second")
+    parser.add_argument("--cycles", type=int, default=5, help="Number of poll cycles to run")
+    parser.add_argument("--cycle-sec", type=float, default=5.0, help="Seconds between poll cycles (Stands in for pollEvery_thMinute)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds of latency added to every fake API call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Chance (0-1) that any fake API call fails")
+    parser.add_argument("--auth-latency", type=float, default=2.0, help="Seconds the fake Google sign in takes at startup")
+    parser.add_argument("--outage", default=None, help="Cycles where every API call fails, for example 2-5")
+    parser.add_argument("--queue-size", type=int, default=1000, help="Advertisements the simulated adapter can hold before dropping them")
+    parser.add_argument("--partition-mode", default=None, choices=["month", "year", "rows"], help="Sheet partitioning (See SheetPartitions)")
+    parser.add_argument("--partition-rows", type=int, default=200000, help="Rows per sheet with --partition-mode rows")
+    parser.add_argument("--compression", default=None, choices=["deadband", "swinging_door"], help="Row compression (See Compression)")
+    parser.add_argument("--json", action="store_true", help="Print the raw result as json (Used when running the standard scenarios)")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.tags != None:
+        result = asyncio.run(run_scenario(args))
+        if args.json:
+            print("BENCHMARK_RESULT " + json.dumps(result))
+        else:
+            print_report(f"{args.tags} tags", result)
+        os._exit(0) #polltags and the GAPI worker thread don't stop on their own
+
+    passthrough = sys.argv[1:]
+    for name, scenarioArgs in standardScenarios.items():
+        output = subprocess.run([sys.executable, __file__, *scenarioArgs, *passthrough, "--json"], capture_output=True, text=True, cwd=scriptDir)
+        resultLines = [line for line in output.stdout.splitlines() if line.startswith("BENCHMARK_RESULT ")]
+        if not resultLines:
+            print(f"\n== {name} ==\nFailed:\n{output.stderr[-2000:]}")
+            continue
+        print_report(name, json.loads(resultLines[-1][len("BENCHMARK_RESULT "):]))
@@ -0,0 +1,110 @@
+import Metrics
+
+#Drops logged rows that carry no new information before they reach the CSV and sheets. A row is kept when any field with a tolerance
+#moves by more than its tolerance, or heartbeatSec has passed since the last kept row. Fields without a tolerance don't decide anything.
+#  "deadband"      : Kept when a field is more than its tolerance away from the last kept row.
+#  "swinging_door" : Kept when a straight line from the last kept row can no longer pass within tolerance of every row since.
+#                    Joining the kept rows with straight lines rebuilds every dropped row within tolerance, and trends cost two rows
+#                    instead of one per reading. Rows are kept one reading late (The door closes on the reading after), so the
+#                    row being held gets flushed by flush() on shutdown.
+
+method = None #None (Keep every row), "deadband" or "swinging_door"
+heartbeatSec = 60 * 60
+#Units are as logged, temperature is in F. Window aggregation columns (temperature_min, ...) use the same tolerance.
+tolerances = {"temperature": 0.2, "humidity": 1.0, "pressure": 0.5, "battery": 20}
+
+rowsIn = 0
+rowsKept = 0
+
+def tolerance_of(name:str):
+    tolerance = tolerances.get(name)
+    if tolerance == None and name.endswith(("_min", "_max", "_mean")):
+        tolerance = tolerances.get(name.rsplit("_", 1)[0])
+    return tolerance
+
+class RowCompressor:
+    __slots__ = ("archived", "held", "slopes")
+
+    def __init__(self):
+        self.archived = None #(timestamp, fields) of the last kept row
+        self.held = None #Latest row which hasn't been kept (yet)
+        self.slopes = {} #field -> [highest lower slope, lowest upper slope] from archived (swinging_door)
+
+    def keep(self, timestamp:float, fields:dict):
+        global rowsKept
+        rowsKept += 1
+        self.archived = (timestamp, fields)
+        self.held = None
+        self.slopes = {}
+        return (timestamp, fields)
+
+    def changed_shape(self, fields:dict):
+        archivedFields = self.archived[1]
+        return fields.keys() != archivedFields.keys() or any((fields[name] == None) != (archivedFields[name] == None) for name in fields)
+
+    def outside_deadband(self, fields:dict):
+        for name, value in fields.items():
+            tolerance = tolerance_of(name)
+            if tolerance != None and value != None and abs(value - self.archived[1][name]) > tolerance:
+                return True
+        return False
+
+    #Narrows each field's door with the new row. True if the new row can't end the line: its own slope from the archived row misses the
+    #door left by the rows in between, so joining the two would put one of those more than its tolerance off.
+    def door_closed(self, timestamp:float, fields:dict):
+        archivedTime, archivedFields = self.archived
+        elapsed = timestamp - archivedTime
+        if elapsed <= 0:
+            return False
+        closed = False
+        for name, value in fields.items():
+            tolerance = tolerance_of(name)
+            if tolerance == None or value == None:
+                continue
+            exact = (value - archivedFields[name]) / elapsed
+            lower = exact - tolerance / elapsed
+            upper = exact + tolerance / elapsed
+            slope = self.slopes.get(name)
+            if slope == None:
+                self.slopes[name] = [lower, upper]
+                continue
+            closed = closed or not (slope[0] <= exact <= slope[1])
+            slope[0] = max(slope[0], lower)
+            slope[1] = min(slope[1], upper)
+        return closed
+
+    #Returns the rows to store, [(timestamp, fields)]. Usually empty or one row, at most two.
+    def add(self, timestamp:float, fields:dict):
+        global rowsIn
+        rowsIn += 1
+        if method == None:
+            return [(timestamp, fields)]
+        if self.archived == None or self.changed_shape(fields):
+            kept = [self.keep(*self.held)] if self.held != None else []
+            return kept + [self.keep(timestamp, fields)]
+
+        kept = []
+        if method == "deadband":
+            if timestamp - self.archived[0] >= heartbeatSec or self.outside_deadband(fields):
+                kept.append(self.keep(timestamp, fields))
+            return kept
+
+        if self.door_closed(timestamp, fields):
+            kept.append(self.keep(*self.held)) #The held row is the last one the old line covered, start the new line from it
+            self.door_closed(timestamp, fields)
+        if timestamp - self.archived[0] >= heartbeatSec:
+            kept.append(self.keep(timestamp, fields))
+        else:
+            self.held = (timestamp, fields)
+        return kept
+
+    def flush(self):
+        if self.held == None:
+            return []
+        return [self.keep(*self.held)]
+
+def compression_metrics():
+    return [("counter", "compression_rows_in_total", {}, rowsIn), ("counter", "compression_rows_kept_total", {}, rowsKept),
+            ("gauge", "compression_ratio", {}, rowsIn / rowsKept if rowsKept else 1.0)]
+
+Metrics.collectors.append(compression_metrics)
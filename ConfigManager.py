@@ -1,7 +1,10 @@
 import csv
 import os
+import time
 from dataclasses import dataclass
+from io import StringIO
 
+import GAPIAsync
 import GAPIHelper as gapi
 from Log import log
 
@@ -44,8 +47,21 @@ configFileHeaders = "Mac,Name,Lower_Threshold_F,Upper_Threshold_F,Enabled\n"
 configFileName = "RuuviConfig.csv"
 
 tagConfigs:dict[str, RuuviConfig] = {}
+configVersion = 0 #Bumped whenever tagConfigs is replaced so anything derived from it knows to rebuild
 firstTimeStart = True
 
+#How we find out that the RuuviConfig sheet changed online:
+#"version" - One cheap Drive metadata call per cycle, the sheet is only downloaded when its version changes.
+#"ttl" - No calls at all until configSyncTtlSec has passed, then the sheet is downloaded again.
+#"always" - Download the sheet every cycle.
+configSyncMode = "version"
+configSyncTtlSec = 60 * 60
+
+lastSyncedVersion = None
+lastSyncTime = float("-inf")
+onlineMacs = set() #Tags which are already listed in the online sheet
+onlineSheetEmpty = False
+
 def create_config_from_csv_list(listifiedData):
     config = {}
     for row in listifiedData[1:]:
@@ -53,11 +69,12 @@ def create_config_from_csv_list(listifiedData):
     return config
 
 def load_local_file():
-    global tagConfigs
+    global tagConfigs, configVersion
     try:
         with open(scriptDir + "/" + configFileName, 'r') as localConfig:
             listifiedData = list(csv.reader(localConfig))
             tagConfigs = create_config_from_csv_list(listifiedData)
+            configVersion += 1
     except FileNotFoundError:
         pass #Will be made later
 
@@ -76,46 +93,91 @@ def write_local_config(csvString):
     except:
         pass
 
-def get_latest_config(recentMacs):
-    global tagConfigs
+#The Drive version number out of gapi.get_file_version's "version@modifiedTime"
+def version_number(version:str):
+    try:
+        return int(version.split("@")[0])
+    except (AttributeError, ValueError):
+        return None
+
+async def find_config_sheet():
+    parentFolderId = await GAPIAsync.call(gapi.find_object, gapi.obj.folder, "config", "root")
+    if not parentFolderId:
+        parentFolderId = await GAPIAsync.call(gapi.create_object, gapi.obj.folder, "config", "root")
+
+    sheetId = await GAPIAsync.call(gapi.find_object, gapi.obj.sheet, "RuuviConfig", parentFolderId)
+    if not sheetId:
+        sheetId = await GAPIAsync.call(gapi.create_object, gapi.obj.sheet, "RuuviConfig", parentFolderId)
+    return sheetId
+
+async def get_latest_config(recentMacs):
+    global tagConfigs, configVersion, lastSyncedVersion, lastSyncTime, onlineMacs, onlineSheetEmpty
     if recentMacs == []:
         return #If we didn't get any tags this round, then there is nothing to be done here.
 
     for tag in recentMacs:
         tagConfigs.setdefault(tag, RuuviConfig())
 
-    parentFolderId = gapi.find_object(gapi.obj.folder, "config", "root")
-    if not parentFolderId:
-        parentFolderId = gapi.create_object(gapi.obj.folder, "config", "root")
-
-    sheetId = gapi.find_object(gapi.obj.sheet, "RuuviConfig", parentFolderId)
-    if not sheetId:
-        sheetId = gapi.create_object(gapi.obj.sheet, "RuuviConfig", parentFolderId)
-
+    sheetId = await find_config_sheet()
     if not sheetId:
         log("Unable to generate the RuuviConfig on Drive for the first time.")
         return
 
-    latestConfig = gapi.get_full_sheet(sheetId, "sheet1")
-
-    #Latest config is built up from the web first (taking priority), then anything local is added which should be just completely new tags.
-    #The result is saved off in program memory, locally, and online
-    configFromOnline = create_config_from_csv_list(latestConfig)
-
-    configToUpload = configFromOnline.copy()
-    for tag in tagConfigs:
-        if tag not in configToUpload:
-            configToUpload[tag] = tagConfigs[tag]
-
-    tagConfigs = configToUpload
-    if configToUpload == configFromOnline:
-        if firstTimeStart:
-            #This fixes an edge case where if you start up and your config never changes, your local file will never write.
+    version = None
+    if configSyncMode == "version":
+        version = await GAPIAsync.call(gapi.get_file_version, sheetId)
+        needsDownload = version != lastSyncedVersion
+    elif configSyncMode == "ttl":
+        needsDownload = time.time() >= lastSyncTime + configSyncTtlSec
+    else:
+        needsDownload = True
+
+    configChanged = False
+    if needsDownload:
+        latestConfig = await GAPIAsync.call(gapi.get_full_sheet, sheetId, "sheet1")
+        lastSyncedVersion = version
+        lastSyncTime = time.time()
+
+        #Latest config is built up from the web first (taking priority), then anything local is added which should be just completely new tags.
+        #The result is saved off in program memory, locally, and online
+        configFromOnline = create_config_from_csv_list(latestConfig)
+        onlineMacs = set(configFromOnline)
+        onlineSheetEmpty = latestConfig == [] or latestConfig == [[]]
+
+        latestTagConfigs = configFromOnline.copy()
+        for tag in tagConfigs:
+            if tag not in latestTagConfigs:
+                latestTagConfigs[tag] = tagConfigs[tag]
+
+        configChanged = latestTagConfigs != tagConfigs
+        tagConfigs = latestTagConfigs
+        if configChanged:
+            configVersion += 1
+
+    newTags = [tag for tag in tagConfigs if tag not in onlineMacs]
+    if not newTags:
+        if configChanged or firstTimeStart:
+            #This also fixes an edge case where if you start up and your config never changes, your local file will never write.
             #I also didn't want to write to the local file every time because it is likely an SD card and technically has limited writes.
             write_local_config(get_config_csv())
         return
 
     csvString = get_config_csv()
-
     write_local_config(csvString)
-    gapi.write_to_sheet(sheetId, 1, csvString)
+
+    if onlineSheetEmpty:
+        await GAPIAsync.call(gapi.write_to_sheet, sheetId, 1, csvString)
+    else:
+        #Only push the rows that are new rather than rewriting the whole sheet.
+        newRows = list(csv.reader(StringIO("".join([tagConfigs[tag].stringify(tag) for tag in newTags]))))
+        if not await GAPIAsync.call(gapi.append_to_sheet, newRows, sheetId):
+            raise(Exception("The RuuviConfig sheet disappeared while adding new tags to it"))
+    onlineMacs.update(newTags)
+    onlineSheetEmpty = False
+
+    if configSyncMode == "version":
+        #Our own write bumps the version by one, don't download the sheet again for that. Any more and someone else edited it since we checked.
+        writtenVersion = await GAPIAsync.call(gapi.get_file_version, sheetId)
+        checkedNumber = version_number(version)
+        if checkedNumber != None and version_number(writtenVersion) == checkedNumber + 1:
+            lastSyncedVersion = writtenVersion
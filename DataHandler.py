@@ -2,24 +2,20 @@ import os
 import time
 from datetime import datetime
 
+import Compression
 import EmailHandler
 import GAPIHelper
+import HistoryWriter
+import SheetPartitions
 
 from ConfigManager import RuuviConfig
 from RuuviPoller import RuuviData
 
 scriptDir = os.path.dirname(os.path.realpath(__file__))
 dataFolderName = "data"
-
-unwantedHeaders = [
-        "acceleration",
-        "acceleration_x",
-        "acceleration_y",
-        "acceleration_z",
-        "tx_power",
-        "movement_counter",
-        "data_format",
-]
+temperatureKeys = ["temperature", "temperature_min", "temperature_max", "temperature_mean"]
+alertRetrySec = 5 * 60 #A temperature alert that couldn't be sent is tried again after this, doubling each time it fails again
+alertRetryMaxSec = 60 * 60
 
 class DataHandler:
     def __init__(self, mac:str, emailAlertTimeoutHour:float):
@@ -27,10 +23,27 @@ class DataHandler:
 
         self.emailDelayTimeSec = 60 * 60 * emailAlertTimeoutHour
         self.lastEmailTime = float('-inf')
+        self.alertQueued = False
+        self.failedAlerts = 0
+        self.nextAlertRetryTime = float('-inf')
+        self.compressor = Compression.RowCompressor()
+
+    def alert_due(self):
+        now = time.time()
+        return not self.alertQueued and now >= self.lastEmailTime + self.emailDelayTimeSec and now >= self.nextAlertRetryTime
 
-        self.fileId = 0
+    def on_alert_sent(self, status):
+        self.alertQueued = False
+        if status != None:
+            self.lastEmailTime = time.time()
+            self.failedAlerts = 0
+        else:
+            #Otherwise the next advertisement (A second or so later) queues it again, which during an outage is a failed send every few seconds
+            self.nextAlertRetryTime = time.time() + min(alertRetrySec * 2 ** self.failedAlerts, alertRetryMaxSec)
+            self.failedAlerts += 1
 
-    def check_and_send_temperature_alert(self, temperatureF:float, config:RuuviConfig):
+    #The email is queued up with EmailHandler, it goes out on the next EmailHandler.send_digest()
+    def check_and_queue_temperature_alert(self, temperatureF:float, config:RuuviConfig):
         if temperatureF > config.upperThresholdF:
             thresholdOfMsg = f"upper threshold of {config.upperThresholdF:.2f}F.\n"
         elif temperatureF < config.lowerThresholdF:
@@ -38,40 +51,44 @@ class DataHandler:
         else:
             return #No alert needed, all is well!
 
-        if time.time() >= self.lastEmailTime + self.emailDelayTimeSec:
+        if self.alert_due():
             message = f"The greenhouse sensor '{config.name} {self.shortmac}' is currently at {temperatureF:.2f}F and has exceeded the "
             message += thresholdOfMsg
             message += f"\nThis message will repeat every {self.emailDelayTimeSec/60/60} hours until it is resolved.\nSave those plants, good luck!"
             print(message)
-            message += "\n\n-The Greenhouse Monitor"
-            status = EmailHandler.send_message("Automatic Greenhouse Temperature Alert", message, rxEmails=None)
-            if status != None:
-                self.lastEmailTime = time.time()
+            self.alertQueued = True
+            EmailHandler.queue_message("Automatic Greenhouse Temperature Alert", message, rxEmails=None, onSent=self.on_alert_sent)
 
-    def handle_data(self, data:RuuviData, config:RuuviConfig):
-        for header in unwantedHeaders:
-            data.data.pop(header)
-
-        data.data["temperature"] = data.data['temperature'] * 1.8 + 32 #'merica!
-        self.check_and_send_temperature_alert(data.data["temperature"], config)
+    #Returns [(timestamp, SheetAppend)] for the rows to upload, which is empty when Compression drops the reading.
+    async def handle_data(self, data:RuuviData, config:RuuviConfig):
+        fields = data.fields()
+        for key in temperatureKeys:
+            if fields.get(key) != None:
+                fields[key] = fields[key] * 1.8 + 32 #'merica!
+        #Temperature alerts are checked on every advertisement by AlertMonitor rather than here
 
+        sensorId = config.name + self.shortmac
         readableTime = datetime.fromtimestamp(data.timestamp).strftime('%Y-%m-%d %H:%M:%S')
+        print(f"{sensorId} was {fields['temperature'] if fields['temperature'] == None else round(fields['temperature'], 2)}F on {readableTime}")
+        return [self.store_row(timestamp, rowFields, config) for timestamp, rowFields in self.compressor.add(data.timestamp, fields)]
+
+    #The reading Compression is holding on to, for shutdown
+    def flush_held(self, config:RuuviConfig):
+        return [self.store_row(timestamp, rowFields, config) for timestamp, rowFields in self.compressor.flush()]
+
+    def store_row(self, timestamp:float, fields:dict, config:RuuviConfig):
+        readableTime = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
 
         #Save to CSV file
         sensorId = config.name + self.shortmac
         dataFolderPath = f"{scriptDir}/{dataFolderName}/"
         filepath = f"{dataFolderPath}{sensorId}_data.csv"
         #TODO Error handling
-        headerLine = "time,timestamp," + ",".join(data.data.keys()) + "\n"
-        dataLine = readableTime + "," + str(data.timestamp) + "," + ",".join([str(val) for val in data.data.values()]) + "\n"
-
-        os.makedirs(dataFolderPath, exist_ok=True)
-        newLocalFileData = ""
-        if not os.path.isfile(filepath):
-            newLocalFileData = headerLine
-        newLocalFileData += dataLine
-        with open(filepath, 'a+') as dataFile:
-            dataFile.write(newLocalFileData)
-
-        print(f"{sensorId} was {data.data['temperature']:.2f}F on {readableTime}")
-        self.fileId = GAPIHelper.append_to_sheet_make_if_dne(headerLine, dataLine, self.fileId, dataFolderName, sensorId)
+        headerLine = "time,timestamp," + ",".join(fields.keys()) + "\n"
+        dataLine = readableTime + "," + str(timestamp) + "," + ",".join([str(val) for val in fields.values()]) + "\n"
+        HistoryWriter.write(filepath, headerLine, dataLine)
+
+        #Uploading is left to the caller so every tag can go out in the same batch
+        sheetName = SheetPartitions.sheet_name(sensorId, dataFolderName, headerLine, timestamp)
+        return timestamp, GAPIHelper.SheetAppend(headerLine, dataLine, 0, dataFolderName, sheetName)
+
@@ -4,7 +4,9 @@ import Log
 
 from email.mime.text import MIMEText
 
+import GAPIAsync
 import GAPIHelper
+import Metrics
 
 scriptDir = os.path.dirname(os.path.realpath(__file__))
 debugOnly = False
@@ -20,10 +22,25 @@ except:
 if emailList == []:
     print(f"Please add emails to the following file if you would like to use the email alert feature.\n{os.path.normpath(emailListPath)}")
 
+#The sender address only changes if we sign in as someone else, so look it up once per token.
+senderEmail = None
+senderToken = None
+
+#Digest mode merges every alert queued before the next send_digest() into one email per recipient list.
+digestMode = True
+signature = "\n\n-The Greenhouse Monitor"
+queuedMessages:dict[tuple, list] = {} #recipients -> [(subject, messageText, onSent)]
+
 @GAPIHelper.authorize
-def create_message(rxEmails:list[str], subject, messageText):
-    userinfo = GAPIHelper.infoService.userinfo().get().execute()
-    txEmail = userinfo.get('email')
+@GAPIHelper.backoff_retry
+def fetch_sender_email():
+    global senderEmail, senderToken
+    userinfo = GAPIHelper.info_service().userinfo().get().execute()
+    senderEmail = userinfo.get('email')
+    senderToken = GAPIHelper.userToken
+    return senderEmail
+
+def create_message(rxEmails:list[str], subject, messageText, txEmail):
     message = MIMEText(messageText)
     message['to'] = ", ".join(rxEmails)
     message['from'] = txEmail
@@ -31,18 +48,56 @@ def create_message(rxEmails:list[str], subject, messageText):
     return {'raw': base64.urlsafe_b64encode(message.as_bytes('utf-8')).decode()}
 
 @GAPIHelper.authorize
-def send_message(subject:str, messageText:str, rxEmails:list[str] = None):
+def deliver_message(rawMessage):
+    message = (GAPIHelper.gmail_service().users().messages().send(userId='me', body=rawMessage).execute())
+    return message['id']
+
+async def send_message(subject:str, messageText:str, rxEmails:list[str] = None):
     if rxEmails == None:
         rxEmails = emailList
-    rawMessage = create_message(rxEmails, subject, messageText)
+
+    txEmail = senderEmail
+    if txEmail == None or senderToken is not GAPIHelper.userToken:
+        txEmail = await GAPIAsync.call(fetch_sender_email)
+    rawMessage = create_message(rxEmails, subject, messageText + signature, txEmail)
 
     if debugOnly:
         print("I am not actually going to send that email. I am in debug only mode!")
         return 0
 
     try:
-        message = (GAPIHelper.gmailService.users().messages().send(userId='me', body=rawMessage).execute())
-        return message['id']
+        #Not retried, we would rather miss an email than send it twice
+        messageId = await GAPIAsync.run(deliver_message, rawMessage)
+        Metrics.count("emails_sent_total")
+        return messageId
     except Exception as error:
-        Log.log(error)
-        return None
\ No newline at end of file
+        Log.log(str(error))
+        Metrics.count("email_failures_total")
+        return None
+
+#onSent is called with the message id (None if it failed to send) once the message actually goes out.
+def queue_message(subject:str, messageText:str, rxEmails:list[str] = None, onSent = None):
+    if rxEmails == None:
+        rxEmails = emailList
+    queuedMessages.setdefault(tuple(rxEmails), []).append((subject, messageText, onSent))
+
+async def send_digest():
+    toSend = queuedMessages.copy()
+    queuedMessages.clear()
+    for rxEmails, messages in toSend.items():
+        if digestMode and len(messages) > 1:
+            subject = f"Automatic Greenhouse Alerts ({len(messages)})"
+            messageText = "\n\n----------\n\n".join([f"{msgSubject}\n{msgText}" for msgSubject, msgText, _ in messages])
+            batches = [(subject, messageText, messages)]
+        else:
+            batches = [(message[0], message[1], [message]) for message in messages]
+
+        for subject, messageText, sentMessages in batches:
+            status = None
+            try:
+                status = await send_message(subject, messageText, list(rxEmails))
+            except Exception as e:
+                Log.log(f"send_digest: {str(e)}")
+            for _, _, onSent in sentMessages:
+                if onSent != None:
+                    onSent(status)
@@ -0,0 +1,110 @@
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import GAPIHelper as gapi
+import Log
+import Metrics
+
+#Everything in GAPIHelper blocks, so it gets run on a worker thread here to keep it off of the event loop (and away from BLE polling).
+#The Google client is not thread safe, so keep this at 1 unless each worker is given its own services.
+maxWorkers = 1
+tokenRefreshAheadSec = 60 * 10 #How long before the token expires keep_token_fresh refreshes it
+
+executor = None
+
+def init_worker():
+    gapi.retryState.deferred = True #call() handles the retries with asyncio.sleep instead
+
+def get_executor():
+    global executor
+    if executor == None:
+        executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="gapi", initializer=init_worker)
+    return executor
+
+#Runs func once on the worker thread.
+async def run(func, *args, **kwargs):
+    with Metrics.timer("gapi_call_seconds", call=func.__name__):
+        return await asyncio.get_running_loop().run_in_executor(get_executor(), partial(func, *args, **kwargs))
+
+#Runs func on the worker thread with the same backoff as GAPIHelper.backoff_retry, except it doesn't hold up the event loop while waiting.
+async def call(func, *args, **kwargs):
+    numRetries = 0
+    while True:
+        try:
+            return await run(func, *args, **kwargs)
+        except Exception as e:
+            if gapi.is_not_found(e):
+                raise(e) #Retrying won't make it exist. Let the caller decide what to do.
+            numRetries+=1
+            if(numRetries >= gapi.retryLimit):
+                Log.log(f"Maximum retries exceeded for {func.__name__}")
+                Metrics.count("gapi_gave_up_total", call=func.__name__)
+                raise(e)
+            Log.log(f"{func.__name__}: {str(e)}")
+            Metrics.count("gapi_retries_total", call=func.__name__)
+            await asyncio.sleep((random.randint(500,1000)*numRetries)/1000)
+
+#Batched version of GAPIHelper.append_to_sheet_make_if_dne. Appends whose sheet is already known go out together in as few requests as possible,
+#anything new or missing falls back to the find/create path. Returns a dict of key -> fileId, or key -> exception if that append failed.
+async def batch_append_to_sheets_make_if_dne(appends:"dict[str, gapi.SheetAppend]"):
+    responses = {}
+    for append in appends.values():
+        if not append.fileId:
+            append.fileId = gapi.cached_sheet_id(append.folderName, append.fileName)
+    knownAppends = [(key, append) for key, append in appends.items() if append.fileId]
+    for start in range(0, len(knownAppends), gapi.batchLimit):
+        chunk = dict(knownAppends[start:start + gapi.batchLimit])
+        try:
+            responses.update(await call(gapi.batch_append_to_sheets, chunk))
+        except Exception as e:
+            responses.update({key: e for key in chunk})
+
+    results = {}
+    for key, append in appends.items():
+        response = responses.get(key)
+        if response != None and not isinstance(response, Exception):
+            results[key] = append.fileId
+            continue
+        if isinstance(response, Exception):
+            if not gapi.is_not_found(response):
+                results[key] = response
+                continue
+            gapi.invalidate_object_id(append.fileId)
+
+        try:
+            results[key] = await call(gapi.append_to_sheet_make_if_dne, append.headerLine, append.dataLine, 0, append.folderName, append.fileName)
+        except Exception as e:
+            results[key] = e
+    return results
+
+#Gets the first token without holding up the event loop, so BLE polling runs while we wait on the network (Or the user).
+async def acquire_token():
+    failCount = 0
+    while True:
+        try:
+            if await run(gapi.get_valid_token):
+                gapi.update_token_deadline()
+                return
+        except Exception as e:
+            Log.log(f"Unable to get a valid token: {str(e)}")
+        failCount += 1
+        await asyncio.sleep(5 * min(failCount, 60)) #Back off to a maximum of retry every 5 minutes
+
+#Keeps the token refreshed in the background so no API call has to wait on a refresh (Or fall off of authorize's fast path).
+#Runs through the worker thread like everything else so the refresh never overlaps another request.
+async def keep_token_fresh():
+    await acquire_token()
+    while True:
+        refreshIn = gapi.tokenGoodUntil + gapi.tokenExpirySkewSec - tokenRefreshAheadSec - time.time()
+        if refreshIn > 0:
+            await asyncio.sleep(min(refreshIn, 60 * 60)) #Capped so a token swapped in by get_valid_token gets noticed
+            continue
+        try:
+            if await call(gapi.refresh_token_early):
+                continue
+        except Exception as e:
+            Log.log(f"Unable to refresh the token early: {str(e)}")
+        await asyncio.sleep(60) #authorize falls back to get_valid_token if this never succeeds
@@ -1,20 +1,23 @@
 import google.auth.exceptions as g_exception
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
+#googleapiclient, google_auth_oauthlib and google.auth.transport.requests take seconds to import on a Pi,
+#so they are imported where they are first needed instead of holding up startup (And BLE polling).
 
 import csv
+import json
 import os
 import time
 import random
+import threading
 
+from dataclasses import dataclass
+from datetime import timezone
 from enum import Enum
-from io import StringIO
+from functools import wraps
+from io import BytesIO, StringIO
 
 import Log
+import Metrics
 
 class obj(Enum):
     folder = "application/vnd.google-apps.folder"
@@ -24,21 +27,41 @@ class obj(Enum):
 scriptDir = os.path.dirname(os.path.realpath(__file__))
 defaultAppTokenLoc = f"{scriptDir}/AppToken.json"
 defaultUserTokenLoc = f"{scriptDir}/UserToken.json"
+defaultIdCacheLoc = f"{scriptDir}/DriveIdCache.json"
+defaultDiscoveryCacheDir = f"{scriptDir}/DiscoveryCache"
 appScope = ['openid', 'https://www.googleapis.com/auth/gmail.send', 'https://www.googleapis.com/auth/userinfo.email', 'https://www.googleapis.com/auth/drive', 'https://www.googleapis.com/auth/spreadsheets']
 
 
 appTokenLoc = defaultAppTokenLoc
 userTokenLoc = defaultUserTokenLoc
+idCacheLoc = defaultIdCacheLoc
+discoveryCacheDir = defaultDiscoveryCacheDir
 
 userToken = Credentials(None)
-resourcesValid = False
+tokenGoodUntil = 0.0 #authorize() skips all token checks until this time. See GAPIAsync.keep_token_fresh, which refreshes well before it.
+tokenExpirySkewSec = 60 #Treat the token as expired this early so a call doesn't start with seconds left on it
 
-driveService = None
-sheetsService = None
-infoService = None
-gmailService = None
+#Service name -> client, built on first use by get_service. Clients hold a reference to userToken,
+#so they only need rebuilding when userToken is replaced (Not when it is refreshed).
+services = {}
+serviceVersions = {"drive": "v3", "oauth2": "v2", "sheets": "v4", "gmail": "v1"}
+
+#(mimeType, parent, name) -> fileId. Saved to idCacheLoc so we don't need to search Drive for the same objects every cycle/restart
+objectIdCache:dict[str, str] = {}
+idCacheLoaded = False
 
 retryLimit = 3
+retryState = threading.local() #Threads which set retryState.deferred make a single attempt and leave retrying up to the caller (See GAPIAsync)
+batchLimit = 100 #Google caps how many calls can be packed into one batch request
+
+#One row (or several newline separated rows) destined for the sheet 'fileName' inside of the root folder 'folderName'
+@dataclass
+class SheetAppend:
+    headerLine:str
+    dataLine:str
+    fileId:str
+    folderName:str
+    fileName:str
 
 def change_app_token_location(path):
     global appTokenLoc
@@ -48,42 +71,69 @@ def change_user_token_location(path):
     global userTokenLoc
     userTokenLoc = path
 
+def change_id_cache_location(path):
+    global idCacheLoc, idCacheLoaded
+    idCacheLoc = path
+    idCacheLoaded = False
+
 def is_authorized():
     return userToken.valid
 
+def update_token_deadline():
+    global tokenGoodUntil
+    if not userToken.valid:
+        tokenGoodUntil = 0.0
+    elif userToken.expiry == None:
+        tokenGoodUntil = float('inf') #No expiry, it is good until Google rejects it
+    else:
+        tokenGoodUntil = userToken.expiry.replace(tzinfo=timezone.utc).timestamp() - tokenExpirySkewSec
+
+def is_not_found(e:Exception):
+    from googleapiclient.errors import HttpError
+    return type(e) == HttpError and e.resp.status == 404
+
 def backoff_retry(func):
+    @wraps(func)
     def wrapper(*args, **kwargs):
+        if getattr(retryState, "deferred", False):
+            return func(*args, **kwargs)
         numRetries = 0
         while numRetries < retryLimit:
             try:
                 funcReturn = func(*args, **kwargs)
                 return funcReturn
             except Exception as e:
+                if is_not_found(e):
+                    raise(e) #Retrying won't make it exist. Let the caller decide what to do.
                 numRetries+=1
                 if(numRetries >= retryLimit):
                     Log.log(f"Maximum retries exceeded for {func.__name__}")
+                    Metrics.count("gapi_gave_up_total", call=func.__name__)
                     raise(e)
                 Log.log(f"{func.__name__}: {str(e)}")
+                Metrics.count("gapi_retries_total", call=func.__name__)
                 time.sleep((random.randint(500,1000)*numRetries)/1000) #Probably can pick a number between 1 and 1000, but I am being conservative
     return wrapper
 
 def authorize(func):
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        funcReturn = None
-        
+        if time.time() < tokenGoodUntil:
+            return func(*args, **kwargs) #Fast path, nested calls and every call between refreshes land here
+
         if get_valid_token():
-            create_resources()
-            funcReturn = func(*args, **kwargs)
+            update_token_deadline()
+            return func(*args, **kwargs)
         else:
             raise Exception(f"Unable to find/create a valid token. Call to {func.__name__} halted.")
-
-        return funcReturn
     return wrapper
 
 #TODO: Might want to consider what happens if the user intentionally exits the prompt.
 @backoff_retry
 def generate_token_via_user():
     global userToken
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    services.clear() #New credentials object, the services need to be rebuilt around it
     try:
         # TODO, I think we can put this message up on the oauth consent thingy
         print("WARNING: THIS APP DOES NOT ENCRYPT OR MAKE ANY EFFORT TO PROTECT YOUR CREDENTIALS. USE AT YOUR OWN RISK.")
@@ -108,12 +158,14 @@ def load_token_from_file():
     if os.path.exists(userTokenLoc):
         try:
             userToken = Credentials.from_authorized_user_file(userTokenLoc, appScope)
+            services.clear()
         except:
             Log.log(f"Unable to open existing user credentials. Ensure that this script has read/write permissions for {userTokenLoc}")
     return userToken.valid
 
 @backoff_retry
 def refresh_token():
+    from google.auth.transport.requests import Request
     if userToken.expired and userToken.refresh_token:
         try:
             userToken.refresh(Request())
@@ -121,13 +173,25 @@ def refresh_token():
             Log.log(f"refresh_token: {str(e)}") #Assumed no way to fix this without user intervention.
     return userToken.valid
 
+#Refreshes before the token expires. The credentials are refreshed in place, so the services built around them carry on as they are.
+def refresh_token_early():
+    global tokenGoodUntil
+    from google.auth.transport.requests import Request
+    if not userToken.refresh_token:
+        return False
+    try:
+        userToken.refresh(Request())
+    except g_exception.RefreshError as e:
+        tokenGoodUntil = 0.0 #Let the next call go through get_valid_token
+        raise(e)
+    update_token_deadline()
+    Metrics.count("token_refreshes_total")
+    return userToken.valid
+
 def get_valid_token():
-    global resourcesValid
     if userToken.valid:
         return True
 
-    resourcesValid = False #TODO: Check if it is necessary to rebuild these if the token is invalidated in the middle of the program execution
-
     if load_token_from_file():
         return True
     
@@ -136,47 +200,122 @@ def get_valid_token():
 
     return generate_token_via_user()
 
-@backoff_retry
-def create_drive_service():
-    global driveService
-    driveService = build('drive', 'v3', credentials=userToken)
+def discovery_cache_path(name:str):
+    return f"{discoveryCacheDir}/{name}.{serviceVersions[name]}.json"
 
+#Builds from the copy of the discovery document saved last time, so neither the network nor the client library's copy is needed.
+#The first build of each service saves its document for next time.
 @backoff_retry
-def create_info_service():
-    global infoService
-    infoService = build('oauth2', 'v2', credentials=userToken)
+def build_service(name:str):
+    from googleapiclient.discovery import build, build_from_document
+    cachePath = discovery_cache_path(name)
+    if os.path.exists(cachePath):
+        try:
+            with open(cachePath, 'r') as cacheFile:
+                return build_from_document(json.load(cacheFile), credentials=userToken)
+        except Exception as e:
+            Log.log(f"Discarding the cached discovery document for {name}: {str(e)}")
 
-@backoff_retry
-def create_sheets_service():
-    global sheetsService
-    sheetsService = build('sheets', 'v4', credentials=userToken)
+    service = build(name, serviceVersions[name], credentials=userToken)
+    try:
+        os.makedirs(discoveryCacheDir, exist_ok=True)
+        with open(cachePath + ".tmp", 'w') as cacheFile:
+            json.dump(service._rootDesc, cacheFile)
+        os.replace(cachePath + ".tmp", cachePath)
+    except Exception as e:
+        Log.log(f"Unable to cache the discovery document for {name}: {str(e)}")
+    return service
 
-@backoff_retry
-def create_gmail_service():
-    global gmailService
-    gmailService = build('gmail', 'v1', credentials=userToken)
+def get_service(name:str):
+    service = services.get(name)
+    if service == None:
+        if not userToken.valid:
+            raise(Exception(f"Token invalid. Cannot create the {name} service."))
+        with Metrics.timer("build_service_seconds", service=name):
+            service = build_service(name)
+        services[name] = service
+    return service
 
-def create_resources():
-    global resourcesValid
-    if resourcesValid:
+def drive_service():
+    return get_service("drive")
+
+def info_service():
+    return get_service("oauth2")
+
+def sheets_service():
+    return get_service("sheets")
+
+def gmail_service():
+    return get_service("gmail")
+
+def id_cache_key(objType:obj, objName:str, parentFolderId:str):
+    return f"{objType.value}|{parentFolderId}|{objName}"
+
+def load_id_cache():
+    global objectIdCache, idCacheLoaded
+    if idCacheLoaded:
         return
+    idCacheLoaded = True
+    try:
+        with open(idCacheLoc, 'r') as cacheFile:
+            objectIdCache = json.load(cacheFile)
+    except FileNotFoundError:
+        objectIdCache = {}
+    except Exception as e:
+        objectIdCache = {}
+        Log.log(f"Unable to read the Drive id cache, it will be rebuilt: {str(e)}")
 
-    if not userToken.valid:
-        resourcesValid = False
-        raise(Exception("Token invalid. Cannot create resources."))
+def save_id_cache():
+    try:
+        #Write then swap so a power loss can't leave us with half a file
+        with open(idCacheLoc + ".tmp", 'w') as cacheFile:
+            json.dump(objectIdCache, cacheFile)
+        os.replace(idCacheLoc + ".tmp", idCacheLoc)
+    except Exception as e:
+        Log.log(f"Unable to save the Drive id cache: {str(e)}")
 
-    create_drive_service()
-    create_info_service()
-    create_sheets_service()
-    create_gmail_service()
-    resourcesValid = True
+def cache_object_id(objType:obj, objName:str, parentFolderId:str, objectId:str):
+    load_id_cache()
+    if objectIdCache.get(id_cache_key(objType, objName, parentFolderId)) == objectId:
+        return
+    objectIdCache[id_cache_key(objType, objName, parentFolderId)] = objectId
+    save_id_cache()
+
+#Call this whenever Drive tells us an id no longer exists. Anything cached underneath it is dropped as well.
+def invalidate_object_id(objectId:str):
+    load_id_cache()
+    staleKeys = [key for key, cachedId in objectIdCache.items() if cachedId == objectId or key.split("|")[1] == objectId]
+    if not staleKeys:
+        return
+    for key in staleKeys:
+        del objectIdCache[key]
+    save_id_cache()
+
+#Id of the sheet 'fileName' in the root folder 'folderName' if we already know it, without asking Drive.
+def cached_sheet_id(folderName:str, fileName:str):
+    load_id_cache()
+    folderId = objectIdCache.get(id_cache_key(obj.folder, folderName, 'root'))
+    if not folderId:
+        return None
+    return objectIdCache.get(id_cache_key(obj.sheet, fileName, folderId))
+
+def find_object(objType:obj, objName:str, parentFolderId:str):
+    load_id_cache()
+    objectId = objectIdCache.get(id_cache_key(objType, objName, parentFolderId))
+    if objectId:
+        return objectId
+
+    objectId = search_object(objType, objName, parentFolderId)
+    if objectId:
+        cache_object_id(objType, objName, parentFolderId, objectId)
+    return objectId
 
 @authorize
 @backoff_retry
-def find_object(objType:obj, objName:str, parentFolderId:str):
+def search_object(objType:obj, objName:str, parentFolderId:str):
     objectId = None
     query = f"name = '{objName}' and mimeType = '{objType.value}' and '{parentFolderId}' in parents and trashed = false"
-    response = driveService.files().list(q=query, fields="files(id, name)").execute()
+    response = drive_service().files().list(q=query, fields="files(id, name)").execute()
     respFiles = response.get('files', [])
     if respFiles:
         objectId = respFiles[0]['id']
@@ -187,9 +326,10 @@ def find_object(objType:obj, objName:str, parentFolderId:str):
 def create_object(objType:obj, objName:str, parentFolderId:str)->str:
     objectId = None
     metadata = {'name': objName, 'mimeType': f'{objType.value}', 'parents': [parentFolderId]}
-    response = driveService.files().create(body=metadata, fields='id').execute()
+    response = drive_service().files().create(body=metadata, fields='id').execute()
     if 'id' in response:
         objectId = response['id']
+        cache_object_id(objType, objName, parentFolderId, objectId)
     return objectId
 
 #Data should be a comma seperated list (For example "A,B,C")
@@ -199,9 +339,14 @@ def write_to_sheet(fileId, lineNum, data):
     cellRange = f"Sheet1!A{lineNum}"
     listifiedData = list(csv.reader(StringIO(data)))
     toWrite = {'values': listifiedData}
-    response = sheetsService.spreadsheets().values().update(
-        spreadsheetId=fileId, range=cellRange,
-        valueInputOption='USER_ENTERED', body=toWrite).execute()
+    try:
+        response = sheets_service().spreadsheets().values().update(
+            spreadsheetId=fileId, range=cellRange,
+            valueInputOption='USER_ENTERED', body=toWrite).execute()
+    except Exception as e:
+        if is_not_found(e):
+            invalidate_object_id(fileId)
+        raise(e)
     if 'updatedCells' in response:
         return fileId
     else:
@@ -211,9 +356,26 @@ def write_to_sheet(fileId, lineNum, data):
 @backoff_retry
 def get_full_sheet(fileId, sheetName):
     cellRange = sheetName
-    response = sheetsService.spreadsheets().values().get(spreadsheetId=fileId, range=cellRange).execute()
+    try:
+        response = sheets_service().spreadsheets().values().get(spreadsheetId=fileId, range=cellRange).execute()
+    except Exception as e:
+        if is_not_found(e):
+            invalidate_object_id(fileId)
+        raise(e)
     return response.get("values", [[]])
 
+#Cheap metadata lookup which changes any time the file is edited. Lets callers skip downloading a file which hasn't changed.
+@authorize
+@backoff_retry
+def get_file_version(fileId):
+    try:
+        response = drive_service().files().get(fileId=fileId, fields="version,modifiedTime").execute()
+    except Exception as e:
+        if is_not_found(e):
+            invalidate_object_id(fileId)
+        raise(e)
+    return f"{response.get('version')}@{response.get('modifiedTime')}"
+
 #If fileId is '0', it will find/make the file. This function will return the fileId for the file it wrote to. 0 if failed
 @authorize
 @backoff_retry
@@ -221,7 +383,7 @@ def append_to_sheet(listifiedData:list, fileId:str):
     body = {'values': listifiedData}
 
     try:
-        response = sheetsService.spreadsheets().values().append(
+        response = sheets_service().spreadsheets().values().append(
             spreadsheetId=fileId,
             range=f'Sheet1!A1',
             valueInputOption='USER_ENTERED',
@@ -229,30 +391,59 @@ def append_to_sheet(listifiedData:list, fileId:str):
             body=body
         ).execute()
     except Exception as e:
-        if type(e) == HttpError and e.resp.status == 404:
+        if is_not_found(e):
+            invalidate_object_id(fileId)
             return 0
         raise(e)
 
     return fileId
 
-def append_to_sheet_make_if_dne(headerLine, dataLine, fileId, folderName, fileName):
-    listifiedData = list(csv.reader(StringIO(dataLine)))
-    fileId = append_to_sheet(listifiedData, fileId)
+#Sends every append in 'appends' (A dict of key -> SheetAppend) as a single batch request.
+#Returns a dict of key -> response, or key -> exception for the appends which failed.
+@authorize
+@backoff_retry
+def batch_append_to_sheets(appends:dict[str, SheetAppend]):
+    results = {}
+    def callback(key, response, exception):
+        results[key] = exception if exception else response
+
+    batch = sheets_service().new_batch_http_request(callback=callback)
+    for key, append in appends.items():
+        request = sheets_service().spreadsheets().values().append(
+            spreadsheetId=append.fileId,
+            range=f'Sheet1!A1',
+            valueInputOption='USER_ENTERED',
+            insertDataOption='INSERT_ROWS',
+            body={'values': list(csv.reader(StringIO(append.dataLine)))}
+        )
+        batch.add(request, request_id=key)
+    batch.execute()
+    return results
+
+#Finds the sheet 'fileName' inside of the root folder 'folderName', making both (And the sheet's header) if needed.
+def make_sheet_if_dne(headerLine, folderName, fileName):
     #TODO: Turn this logic into a function which can handle a parentFolder names like "/base/folder/sub/"
-    if not fileId:
-        folderId = find_object(obj.folder, folderName, 'root')
+    folderId = find_object(obj.folder, folderName, 'root')
+    if not folderId:
+        folderId = create_object(obj.folder, folderName, 'root')
         if not folderId:
-            folderId = create_object(obj.folder, folderName, 'root')
-            if not folderId:
-                raise(Exception(f"Something strange happened when we attempted to create the folder of {fileName} for appending"))
+            raise(Exception(f"Something strange happened when we attempted to create the folder of {fileName} for appending"))
 
-        fileId = find_object(obj.sheet, fileName, folderId)
+    fileId = find_object(obj.sheet, fileName, folderId)
+    if not fileId:
+        fileId = create_object(obj.sheet, fileName, folderId)
         if not fileId:
-            fileId = create_object(obj.sheet, fileName, folderId)
-            if not fileId:
-                raise(Exception(f"Something strange happened when we attempted to create the sheet {fileName} for appending"))
-            listifiedHeader = list(csv.reader(StringIO(headerLine)))
-            append_to_sheet(listifiedHeader, fileId) #Append our header into the newly created file
+            raise(Exception(f"Something strange happened when we attempted to create the sheet {fileName} for appending"))
+        listifiedHeader = list(csv.reader(StringIO(headerLine)))
+        append_to_sheet(listifiedHeader, fileId) #Append our header into the newly created file
+    return fileId
+
+def append_to_sheet_make_if_dne(headerLine, dataLine, fileId, folderName, fileName):
+    listifiedData = list(csv.reader(StringIO(dataLine)))
+    if fileId:
+        fileId = append_to_sheet(listifiedData, fileId)
+    if not fileId:
+        fileId = make_sheet_if_dne(headerLine, folderName, fileName)
 
         # Try appending our data again.
         if not append_to_sheet(listifiedData, fileId):
@@ -265,20 +456,55 @@ def append_to_sheet_make_if_dne(headerLine, dataLine, fileId, folderName, fileNa
 def update_file(pathToFile:str, fileId:str):
     baseName = os.path.basename(pathToFile)
     metadata = {'name': baseName}
+    from googleapiclient.http import MediaFileUpload
     media = MediaFileUpload(pathToFile)
-    response = driveService.files().update(fileId=fileId, body=metadata, media_body=media).execute()
+    try:
+        response = drive_service().files().update(fileId=fileId, body=metadata, media_body=media).execute()
+    except Exception as e:
+        if is_not_found(e):
+            invalidate_object_id(fileId)
+        raise(e)
     if 'id' in response and 'name' in response and response['name'] == baseName:
         return True
     else:
         return False
 
+@authorize
+@backoff_retry
+def update_file_from_text(text:str, fileName:str, fileId:str):
+    metadata = {'name': fileName}
+    from googleapiclient.http import MediaIoBaseUpload
+    media = MediaIoBaseUpload(BytesIO(text.encode('utf-8')), mimetype=obj.text.value)
+    try:
+        response = drive_service().files().update(fileId=fileId, body=metadata, media_body=media).execute()
+    except Exception as e:
+        if is_not_found(e):
+            invalidate_object_id(fileId)
+        raise(e)
+    if 'id' in response and 'name' in response and response['name'] == fileName:
+        return True
+    else:
+        return False
+
+#Finds (or makes) the text file 'fileName' in the root folder and passes its id to updateFunc.
+def update_text_object(fileName:str, updateFunc):
+    for attempt in range(2):
+        fileId = find_object(obj.text, fileName, 'root')
+        if not fileId:
+            fileId = create_object(obj.text, fileName, 'root')
+            if not fileId:
+                raise(Exception(f"Unable to upload {fileName}"))
+        try:
+            return updateFunc(fileId)
+        except Exception as e:
+            if not is_not_found(e) or attempt > 0:
+                raise(e)
+            #Our cached id was stale, it has been invalidated so look it up again.
+
 def upload_text_from_file(pathToText:str):
     if not os.path.exists(pathToText):
         return False
-    baseName = os.path.basename(pathToText)
-    fileId = find_object(obj.text, baseName, 'root')
-    if not fileId:
-        fileId = create_object(obj.text, baseName, 'root')
-        if not fileId:
-            raise(Exception(f"Unable to upload {pathToText}"))
-    return update_file(pathToText, fileId)
+    return update_text_object(os.path.basename(pathToText), lambda fileId: update_file(pathToText, fileId))
+
+def upload_text(text:str, fileName:str):
+    return update_text_object(fileName, lambda fileId: update_file_from_text(text, fileName, fileId))
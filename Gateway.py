@@ -0,0 +1,260 @@
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+
+import Metrics
+import RuuviPoller as ruuvi
+from Log import log
+from RuuviPoller import Df5Reading
+from ScannerSupervisor import ScannerSupervisor
+
+#Merges advertisements from several sources into the one stream RuuviPoller reads, so coverage grows with more adapters and gateways
+#while this process stays the only one logging, uploading and alerting. Sources are local bluetooth adapters (Each its own scanner,
+#supervised separately) and remote gateways, which run "python3 Gateway.py forward <address> [adapter] [name]" and send us JSON lines
+#over TCP or a unix socket. Turned on from main (gatewayAdapters/gatewayListen), which swaps RuuviPoller.scan_tags for scan_tags here.
+#One reading is heard by several sources, tags number their readings (measurement_sequence_number), so copies of (mac, sequence) within
+#holdSec are compared and only the one with the strongest rssi goes on. Later copies are dropped until rememberSec has passed.
+#Sequence numbers per source also show what each source missed, see gateway_loss_ratio in Metrics.
+
+localAdapters = [""] #"" is the default adapter, ["hci0", "hci1"] scans with both at once
+listenAddress = None #"host:port" or a unix socket path to accept remote gateways on
+holdSec = 0.5 #Delay before a reading goes on, copies from other sources arriving in this time compete on rssi
+rememberSec = 10
+maxSequenceGap = 1000 #A bigger jump is the tag restarting (Or out of range for a long time), not loss
+queueSize = 10000
+reconnectMaxDelaySec = 60
+
+scanTags = ruuvi.scan_tags #The single adapter scanner, main replaces RuuviPoller.scan_tags with ours
+
+class SourceStats:
+    __slots__ = ("heard", "received", "expected", "forwarded", "lastSequence")
+
+    def __init__(self):
+        self.heard = 0 #Every advertisement
+        self.received = 0 #Distinct readings
+        self.expected = 0 #Readings the sequence numbers say were sent while we were listening
+        self.forwarded = 0 #Readings where this source had the copy that went on
+        self.lastSequence = {}
+
+    def add(self, mac:str, sequence:int):
+        self.heard += 1
+        last = self.lastSequence.get(mac)
+        self.lastSequence[mac] = sequence
+        gap = (sequence - last) % 0xFFFF if last != None else 1 #The sequence wraps after 65534, 65535 means not available
+        if gap == 0:
+            return #Tags advertise each reading more than once
+        self.received += 1
+        self.expected += gap if gap <= maxSequenceGap else 1
+
+    def loss_ratio(self):
+        return 1 - self.received / self.expected if self.expected else 0.0
+
+sourceStats:dict[str, SourceStats] = {}
+duplicates = 0
+badLines = 0
+
+def sequence_and_rssi(data:dict|Df5Reading):
+    if type(data) == Df5Reading:
+        return data.sequence(), data.rssi()
+    return data.get("measurement_sequence_number"), data.get("rssi")
+
+class Merger:
+    def __init__(self):
+        self.recent = {} #(mac, sequence) -> [rssi, source, data, sent]
+        self.holding = deque() #(time it goes on, key), in arrival order
+        self.remembering = deque() #(time it is forgotten, key)
+
+    #Returns the advertisements that can go on right away, [(mac, data)]
+    def add(self, source:str, mac:str, data:dict|Df5Reading, now:float):
+        global duplicates
+        sequence, rssi = sequence_and_rssi(data)
+        if source not in sourceStats:
+            sourceStats[source] = SourceStats()
+        stats = sourceStats[source]
+        if sequence == None:
+            stats.heard += 1
+            stats.forwarded += 1
+            return [(mac, data)] #No way to tell copies apart, they just overwrite each other in RuuviPoller
+
+        stats.add(mac, sequence)
+        key = (mac, sequence)
+        entry = self.recent.get(key)
+        if entry == None:
+            self.recent[key] = [rssi, source, data, False]
+            self.holding.append((now + holdSec, key))
+            self.remembering.append((now + rememberSec, key))
+            return []
+        duplicates += 1
+        if not entry[3] and rssi != None and (entry[0] == None or rssi > entry[0]):
+            entry[0:3] = [rssi, source, data]
+        return []
+
+    #Returns the held advertisements which are done waiting for copies
+    def due(self, now:float):
+        released = []
+        while self.holding and self.holding[0][0] <= now:
+            key = self.holding.popleft()[1]
+            entry = self.recent[key]
+            entry[3] = True
+            sourceStats[entry[1]].forwarded += 1
+            released.append((key[0], entry[2]))
+        while self.remembering and self.remembering[0][0] <= now:
+            del self.recent[self.remembering.popleft()[1]]
+        return released
+
+    def next_deadline(self):
+        return self.holding[0][0] if self.holding else None
+
+#Remote gateways send one of these per line
+def encode_line(source:str, mac:str, data:dict|Df5Reading):
+    line = {"source": source, "mac": mac}
+    if type(data) == Df5Reading:
+        line["df5"] = data.payload
+    else:
+        line["data"] = data
+    return (json.dumps(line, separators=(",", ":")) + "\n").encode()
+
+def decode_line(line:bytes, defaultSource:str):
+    message = json.loads(line)
+    mac = message["mac"].upper()
+    if "df5" in message:
+        payload = message["df5"]
+        if len(payload) < 48:
+            raise(ValueError(f"Short data format 5 payload from {mac}"))
+        bytes.fromhex(payload)
+        data = Df5Reading(payload)
+    else:
+        data = message["data"]
+        if type(data) != dict:
+            raise(ValueError(f"Bad data from {mac}"))
+    return str(message.get("source", defaultSource)), mac, data
+
+async def scan_adapter(adapter:str, whitelist, queue:asyncio.Queue):
+    source = adapter if adapter else "default"
+    async def enqueue(mac, data):
+        await queue.put((source, mac, data))
+    await ScannerSupervisor(f"scanner {source}").run(lambda: scanTags(whitelist, adapter), enqueue)
+
+async def start_listener(address:str, queue:asyncio.Queue):
+    async def on_connection(reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        global badLines
+        peer = writer.get_extra_info("peername")
+        defaultSource = f"{peer[0]}:{peer[1]}" if type(peer) == tuple else "local"
+        log(f"Gateway {defaultSource} connected")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    await queue.put(decode_line(line, defaultSource))
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    badLines += 1
+        except Exception as e:
+            log(f"Gateway {defaultSource}: {str(e)}")
+        finally:
+            writer.close()
+        log(f"Gateway {defaultSource} disconnected")
+
+    if address.startswith("/"):
+        return await asyncio.start_unix_server(on_connection, address)
+    host, port = address.rsplit(":", 1)
+    return await asyncio.start_server(on_connection, host, int(port))
+
+#Stands in for RuuviPoller.scan_tags, yields (mac, dict or Df5Reading) from every source with the copies merged
+async def scan_tags(whitelist):
+    queue = asyncio.Queue(queueSize)
+    merger = Merger()
+    tasks = [asyncio.create_task(scan_adapter(adapter, whitelist, queue)) for adapter in localAdapters]
+    server = None
+    try:
+        if listenAddress != None:
+            server = await start_listener(listenAddress, queue)
+        while True:
+            item = None
+            deadline = merger.next_deadline()
+            try:
+                if deadline == None:
+                    item = await queue.get()
+                else:
+                    item = await asyncio.wait_for(queue.get(), max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+            now = time.monotonic()
+            released = []
+            if item != None and (not whitelist or item[1] in whitelist):
+                released = merger.add(*item, now)
+            for mac, data in released + merger.due(now):
+                yield mac, data
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if server != None:
+            server.close()
+            await server.wait_closed()
+
+def gateway_metrics():
+    samples = [("counter", "gateway_duplicates_total", {}, duplicates), ("counter", "gateway_bad_lines_total", {}, badLines)]
+    for source, stats in list(sourceStats.items()):
+        labels = {"source": source}
+        samples += [("counter", "gateway_advertisements_total", labels, stats.heard),
+                    ("counter", "gateway_readings_received_total", labels, stats.received),
+                    ("counter", "gateway_readings_expected_total", labels, stats.expected),
+                    ("counter", "gateway_readings_forwarded_total", labels, stats.forwarded),
+                    ("gauge", "gateway_loss_ratio", labels, stats.loss_ratio())]
+    return samples
+
+Metrics.collectors.append(gateway_metrics)
+
+#Remote gateway side: scans with one adapter and sends everything to the hub at address, reconnecting whenever the connection drops.
+#Advertisements heard while disconnected are kept up to queueSize, past that they are dropped (And show up as loss on the hub).
+async def forward(address:str, adapter:str = "", source:str = None):
+    if source == None:
+        import socket
+        source = f"{socket.gethostname()} {adapter}" if adapter else socket.gethostname()
+    queue = asyncio.Queue(queueSize)
+    dropped = 0
+    async def enqueue(mac, data):
+        nonlocal dropped
+        try:
+            queue.put_nowait(encode_line(source, mac, data))
+        except asyncio.QueueFull:
+            dropped += 1
+    scanTask = asyncio.create_task(ScannerSupervisor(f"scanner {source}").run(lambda: scanTags([], adapter), enqueue))
+
+    restartDelaySec = 1
+    try:
+        while True:
+            writer = None
+            try:
+                if address.startswith("/"):
+                    _, writer = await asyncio.open_unix_connection(address)
+                else:
+                    host, port = address.rsplit(":", 1)
+                    _, writer = await asyncio.open_connection(host, int(port))
+                log(f"Forwarding to {address} as {source}")
+                restartDelaySec = 1
+                while True:
+                    writer.write(await queue.get())
+                    while not queue.empty():
+                        writer.write(queue.get_nowait())
+                    await writer.drain()
+            except OSError as e:
+                log(f"Gateway connection to {address}: {str(e)}, {dropped} advertisements dropped so far. Retrying in {restartDelaySec}s")
+            finally:
+                if writer != None:
+                    writer.close()
+            await asyncio.sleep(restartDelaySec)
+            restartDelaySec = min(restartDelaySec * 2, reconnectMaxDelaySec)
+    finally:
+        scanTask.cancel()
+        await asyncio.gather(scanTask, return_exceptions=True)
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "forward":
+        asyncio.run(forward(*sys.argv[2:5]))
+    else:
+        print("Usage: python3 Gateway.py forward <host:port or unix socket path> [adapter] [name]")
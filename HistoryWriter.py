@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+import Metrics
+from Log import log
+
+#Local CSV history. Rows are held in memory and written out together (a group commit) so the SD card sees one write
+#every flushIntervalSec/flushRowCount instead of an open/write/close per tag per cycle.
+flushIntervalSec = 60 * 15
+flushRowCount = 200
+#"never" - Leave it up to the OS. "commit" - fsync after every group commit. "always" - Write and fsync every row (Hard on SD cards).
+fsyncPolicy = "commit"
+
+openFiles = {} #filepath -> file handle, kept open between commits
+pendingLines:dict[str, list[str]] = {}
+pendingRowCount = 0
+lastFlushTime = time.time()
+writerLock = threading.Lock()
+
+def open_data_file(filepath:str, headerLine:str):
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    if os.path.isfile(filepath):
+        with open(filepath, 'r') as existingFile:
+            existingHeader = existingFile.readline()
+        if existingHeader and existingHeader != headerLine:
+            #The columns changed (Window aggregation turned on/off for example), keep the old rows in their own file.
+            base, ext = os.path.splitext(filepath)
+            oldPath = f"{base}_{datetime.now().strftime('%Y%m%d%H%M%S')}{ext}"
+            os.replace(filepath, oldPath)
+            log(f"Columns for {os.path.basename(filepath)} changed, old data moved to {os.path.basename(oldPath)}")
+    dataFile = open(filepath, 'a')
+    if dataFile.tell() == 0:
+        pendingLines.setdefault(filepath, []).insert(0, headerLine)
+    openFiles[filepath] = dataFile
+
+def flush_locked():
+    global pendingRowCount, lastFlushTime
+    with Metrics.timer("csv_flush_seconds"):
+        write_pending_locked()
+    Metrics.count("csv_rows_written_total", pendingRowCount)
+    pendingRowCount = 0
+    lastFlushTime = time.time()
+
+def write_pending_locked():
+    for filepath, lines in pendingLines.items():
+        if not lines:
+            continue
+        try:
+            dataFile = openFiles[filepath]
+            dataFile.write("".join(lines))
+            dataFile.flush()
+            if fsyncPolicy != "never":
+                os.fsync(dataFile.fileno())
+            lines.clear()
+        except Exception as e:
+            log(f"Unable to write to {filepath}: {str(e)}") #Lines stay pending and are tried again next commit
+
+def write(filepath:str, headerLine:str, dataLine:str):
+    global pendingRowCount
+    with writerLock:
+        if filepath not in openFiles:
+            open_data_file(filepath, headerLine)
+        pendingLines.setdefault(filepath, []).append(dataLine)
+        pendingRowCount += 1
+        if fsyncPolicy == "always" or pendingRowCount >= flushRowCount or time.time() >= lastFlushTime + flushIntervalSec:
+            flush_locked()
+
+def flush_if_due():
+    with writerLock:
+        if pendingRowCount and time.time() >= lastFlushTime + flushIntervalSec:
+            flush_locked()
+
+def flush():
+    with writerLock:
+        flush_locked()
+
+def close():
+    with writerLock:
+        flush_locked()
+        for dataFile in openFiles.values():
+            dataFile.close()
+        openFiles.clear()
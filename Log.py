@@ -1,26 +1,108 @@
 import os
+import threading
+from collections import deque
 from datetime import datetime
 
+import GAPIAsync
 import GAPIHelper as gapi
 
 # TODO maybe replace with logging library later
 
 scriptDir = os.path.dirname(os.path.realpath(__file__))
 logFilePath = scriptDir + "/ErrorLogs.txt"
-maxEntries = 1000
+maxEntries = 1000 #Recent entries kept in memory, from before restarts too
+maxLogBytes = 256 * 1024 #Log file gets rotated to ErrorLogs.1.txt, ErrorLogs.2.txt, etc. once it reaches this size
+rotatedLogCount = 3
+
+recentEntries = deque(maxlen=maxEntries)
+#Drive gets one log file per day (ErrorLogs_2026-01-31.txt). Only days with new entries get uploaded, and only that day's entries go up.
+dailyEntries:dict[str, list[str]] = {} #Day -> that day's entries which are still kept for uploading
+pushedEntryCounts:dict[str, int] = {} #Day -> how many of its entries are already on drive
+maxDailyEntries = 5000 #Oldest entries of the day stop being uploaded past this
+logLock = threading.Lock() #GAPIHelper logs from its worker thread
+logFile = None
+logFileSize = 0
+
+def rotated_log_path(num:int):
+    base, ext = os.path.splitext(logFilePath)
+    return f"{base}.{num}{ext}"
+
+def daily_log_name(day:str):
+    base, ext = os.path.splitext(os.path.basename(logFilePath))
+    return f"{base}_{day}{ext}"
+
+def add_daily_entry(day:str, message:str):
+    entries = dailyEntries.setdefault(day, [])
+    entries.append(message)
+    if len(entries) > maxDailyEntries:
+        del entries[:len(entries) - maxDailyEntries]
+        pushedEntryCounts[day] = 0 #What is on drive no longer lines up with the list, send the whole day again
+
+#Only done once at startup so the entries from before a restart still make it to drive.
+def load_recent_entries():
+    for path in [rotated_log_path(num) for num in range(rotatedLogCount, 0, -1)] + [logFilePath]:
+        try:
+            with open(path, 'r') as oldLog:
+                recentEntries.extend(line.rstrip("\n") for line in oldLog)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Unable to read old log {path}: {str(e)}")
+
+    #Today's file on drive gets replaced on the next push, so it needs to start with everything from before the restart
+    today = datetime.now().strftime("%m/%d/%Y")
+    for entry in recentEntries:
+        if entry.startswith(today):
+            add_daily_entry(datetime.now().strftime("%Y-%m-%d"), entry)
+
+def open_log_file():
+    global logFile, logFileSize
+    logFile = open(logFilePath, 'a', buffering=1) #Line buffered so nothing is lost if we get killed
+    logFileSize = logFile.tell()
+
+def rotate_log_file():
+    global logFile
+    logFile.close()
+    logFile = None
+    for num in range(rotatedLogCount, 1, -1):
+        if os.path.exists(rotated_log_path(num - 1)):
+            os.replace(rotated_log_path(num - 1), rotated_log_path(num))
+    os.replace(logFilePath, rotated_log_path(1))
+    open_log_file()
 
 def log(message:str):
-    message = datetime.now().strftime("%m/%d/%Y, %H:%M:%S: ") + message
+    now = datetime.now()
+    message = now.strftime("%m/%d/%Y, %H:%M:%S: ") + message
 
     print(message)
-    with open(logFilePath, 'a+') as logfile:
-        logfile.write(message + "\n")
-        logfile.seek(0)
-        lines = logfile.readlines()
-        if len(lines) > maxEntries:
-            logfile.truncate(0)
-            lines = lines[-maxEntries:]
-            logfile.writelines(lines)
-
-def push_log_to_drive():
-    return gapi.upload_text_from_file(logFilePath)
\ No newline at end of file
+    global logFileSize
+    with logLock:
+        recentEntries.append(message)
+        add_daily_entry(now.strftime("%Y-%m-%d"), message)
+        try:
+            if logFile == None:
+                open_log_file()
+            logFile.write(message + "\n")
+            logFileSize += len(message) + 1
+            if logFileSize >= maxLogBytes:
+                rotate_log_file()
+        except Exception as e:
+            print(f"Unable to write to {logFilePath}: {str(e)}")
+
+#Uploads each day's file which has entries drive hasn't seen yet. Nothing goes over the network when nothing new was logged.
+async def push_log_to_drive():
+    with logLock:
+        changedDays = {day: list(entries) for day, entries in dailyEntries.items() if pushedEntryCounts.get(day) != len(entries)}
+        today = datetime.now().strftime("%Y-%m-%d")
+        for day in [day for day in dailyEntries if day != today and day not in changedDays]:
+            del dailyEntries[day] #Past days that are fully uploaded won't change again
+            pushedEntryCounts.pop(day, None)
+
+    for day, entries in sorted(changedDays.items()):
+        await GAPIAsync.call(gapi.upload_text, "\n".join(entries) + "\n", daily_log_name(day))
+        with logLock:
+            if dailyEntries.get(day, [])[:len(entries)] == entries:
+                pushedEntryCounts[day] = len(entries)
+    return True
+
+load_recent_entries()
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+#Counters and timers which are cheap enough to leave on. Exported as prometheus text (QueryServer /metrics) and to a local stats file.
+#Names follow prometheus conventions, labels are passed as keyword arguments: Metrics.count("emails_sent_total", status="ok")
+
+scriptDir = os.path.dirname(os.path.realpath(__file__))
+statsFilePath = scriptDir + "/Stats.json"
+statsIntervalSec = 60
+loopLagIntervalSec = 1
+
+counters:dict[tuple, float] = {} #(name, labels) -> value
+timers:dict[tuple, list] = {} #(name, labels) -> [count, total seconds, max seconds]
+gauges:dict[tuple, float] = {}
+collectors = [] #Functions returning [(kind, name, labels, value)] for things which are cheaper to count elsewhere (Per tag advertisements for example)
+metricsLock = threading.Lock() #The GAPI worker thread records too
+startTime = time.time()
+
+def key(name:str, labels:dict):
+    return (name, tuple(sorted(labels.items())))
+
+def count(name:str, amount:float = 1, **labels):
+    metricKey = key(name, labels)
+    with metricsLock:
+        counters[metricKey] = counters.get(metricKey, 0) + amount
+
+def set_gauge(name:str, value:float, **labels):
+    with metricsLock:
+        gauges[key(name, labels)] = value
+
+def observe(name:str, seconds:float, **labels):
+    metricKey = key(name, labels)
+    with metricsLock:
+        timer = timers.get(metricKey)
+        if timer == None:
+            timers[metricKey] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+#Works with both regular and awaited code: with Metrics.timer("handle_tag_data"): ...
+class timer:
+    def __init__(self, name:str, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        if excType != None:
+            count(self.name.removesuffix("_seconds") + "_failures_total", **self.labels)
+        return False
+
+def snapshot():
+    with metricsLock:
+        allCounters = dict(counters)
+        allTimers = {metricKey: list(value) for metricKey, value in timers.items()}
+        allGauges = dict(gauges)
+    for collector in collectors:
+        try:
+            for kind, name, labels, value in collector():
+                (allCounters if kind == "counter" else allGauges)[key(name, labels)] = value
+        except Exception as e:
+            print(f"Metrics collector {collector.__name__}: {str(e)}")
+    allGauges[key("uptime_seconds", {})] = time.time() - startTime
+    return allCounters, allTimers, allGauges
+
+def format_labels(labels:tuple):
+    if not labels:
+        return ""
+    return "{" + ",".join([f'{name}="{str(value)}"' for name, value in labels]) + "}"
+
+def prometheus_text():
+    allCounters, allTimers, allGauges = snapshot()
+    lines = []
+    for (name, labels), value in sorted(allCounters.items()):
+        lines.append(f"ruuvi_{name}{format_labels(labels)} {value}")
+    for (name, labels), value in sorted(allGauges.items()):
+        lines.append(f"ruuvi_{name}{format_labels(labels)} {value}")
+    for (name, labels), (timerCount, total, maximum) in sorted(allTimers.items()):
+        lines.append(f"ruuvi_{name}_count{format_labels(labels)} {timerCount}")
+        lines.append(f"ruuvi_{name}_sum{format_labels(labels)} {total}")
+        lines.append(f"ruuvi_{name}_max{format_labels(labels)} {maximum}")
+    return "\n".join(lines) + "\n"
+
+def flat_name(name:str, labels:tuple):
+    return name + format_labels(labels)
+
+lastStats = None
+def write_stats_file():
+    global lastStats
+    now = time.time()
+    allCounters, allTimers, allGauges = snapshot()
+    stats = {
+        "time": now,
+        "counters": {flat_name(*metricKey): value for metricKey, value in allCounters.items()},
+        "gauges": {flat_name(*metricKey): value for metricKey, value in allGauges.items()},
+        "timers": {flat_name(*metricKey): {"count": timerCount, "avgSec": total / timerCount, "maxSec": maximum} for metricKey, (timerCount, total, maximum) in allTimers.items()},
+    }
+    if lastStats != None:
+        #Per second rates since the last write, this is where advertisements/sec per tag shows up
+        elapsed = now - lastStats["time"]
+        stats["ratesPerSec"] = {name: round((value - lastStats["counters"].get(name, 0)) / elapsed, 3) for name, value in stats["counters"].items()}
+    lastStats = stats
+
+    with open(statsFilePath + ".tmp", 'w') as statsFile:
+        json.dump(stats, statsFile, indent=1)
+    os.replace(statsFilePath + ".tmp", statsFilePath)
+
+async def write_stats_periodically():
+    while True:
+        await asyncio.sleep(statsIntervalSec)
+        try:
+            write_stats_file()
+        except Exception as e:
+            print(f"Unable to write {statsFilePath}: {str(e)}")
+
+#How late the event loop wakes us up. Anything blocking the loop (and with it BLE polling) shows up here.
+async def monitor_loop_lag():
+    maxLag = 0
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(loopLagIntervalSec)
+        lag = max(0, time.perf_counter() - start - loopLagIntervalSec)
+        maxLag = max(maxLag, lag)
+        set_gauge("event_loop_lag_seconds", lag)
+        set_gauge("event_loop_lag_max_seconds", maxLag)
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import Log
+from SharedRing import SharedRing
+
+#Runs BLE ingest and everything else (Logging, alerts, uploads) in separate processes so a stall in one can't make the other miss anything.
+#  Supervisor : Owns the shared ring and restarts either process whenever it exits, backing off if it keeps dying.
+#  Ingest     : Just RuuviPoller.scan_tags (Gateway.scan_tags if main set up more adapters or remote gateways), each advertisement goes
+#               straight into the ring.
+#  Worker     : main.main() as usual, with RuuviPoller reading from the ring instead of BLE.
+#Turned on with main.multiProcess. The children are started as "python MultiProcess.py ingest|worker <ring name> [gateway settings]".
+
+scriptDir = os.path.dirname(os.path.realpath(__file__))
+ringSlots = 4096 #About a minute of advertisements from 50 tags, the worker has that long to come back before it misses any
+checkIntervalSec = 1
+maxRestartDelaySec = 60
+
+async def ingest(ring:SharedRing, gatewaySettings:str = None):
+    import RuuviPoller as ruuvi
+    scanTags = ruuvi.scan_tags
+    if gatewaySettings != None:
+        import Gateway
+        settings = json.loads(gatewaySettings)
+        Gateway.localAdapters = settings["adapters"]
+        Gateway.listenAddress = settings["listen"]
+        scanTags = Gateway.scan_tags
+    tooLarge = {} #mac -> advertisements that didn't fit in a slot
+    async def write(mac, data):
+        if not ring.write(time.time(), mac, data):
+            tooLarge[mac] = tooLarge.get(mac, 0) + 1
+            if tooLarge[mac] % 100 == 1: #The first one, then every 100th
+                Log.log(f"Ingest: {tooLarge[mac]} advertisements from {mac} were too large for the shared ring, that tag is not being logged")
+    await ruuvi.scannerSupervisor.run(lambda: scanTags([]), write)
+
+def run_ingest(ringName:str, gatewaySettings:str = None):
+    ring = SharedRing(ringName)
+    try:
+        asyncio.run(ingest(ring, gatewaySettings))
+    finally:
+        ring.close()
+
+def run_worker(ringName:str):
+    ring = SharedRing(ringName)
+    import main
+    import Metrics
+    main.ruuvi.scan_tags = ring.scan_tags
+    Metrics.collectors.append(lambda: [("counter", "shared_ring_lost_total", {}, ring.lost)])
+    try:
+        asyncio.run(main.main())
+    finally:
+        main.flush_held_readings()
+        main.HistoryWriter.close()
+        ring.close()
+
+#main's gateway settings (It has already set them on Gateway) for the ingest process, which doesn't load main. None if there is no gateway.
+def gateway_settings():
+    Gateway = sys.modules.get("Gateway")
+    if Gateway == None or (Gateway.localAdapters == [""] and Gateway.listenAddress == None):
+        return None
+    return json.dumps({"adapters": Gateway.localAdapters, "listen": Gateway.listenAddress})
+
+class Child:
+    def __init__(self, role:str, extraArgs:list[str] = []):
+        self.role = role
+        self.extraArgs = extraArgs
+        self.process = None
+        self.restarts = 0
+        self.startTime = 0.0
+        self.nextStart = 0.0
+        self.restartDelaySec = 1
+
+    def start(self, ringName:str):
+        self.process = subprocess.Popen([sys.executable, f"{scriptDir}/MultiProcess.py", self.role, ringName] + self.extraArgs, cwd=scriptDir)
+        self.startTime = time.time()
+
+    def check(self, ringName:str):
+        if self.process != None:
+            exitCode = self.process.poll()
+            if exitCode == None:
+                if time.time() - self.startTime > maxRestartDelaySec:
+                    self.restartDelaySec = 1 #Stayed up a while, the next crash isn't part of a crash loop
+                return
+            Log.log(f"The {self.role} process exited ({exitCode}), restarting it in {self.restartDelaySec}s")
+            self.process = None
+            self.restarts += 1
+            self.nextStart = time.time() + self.restartDelaySec
+            self.restartDelaySec = min(self.restartDelaySec * 2, maxRestartDelaySec)
+        if time.time() >= self.nextStart:
+            self.start(ringName)
+
+    def stop(self):
+        if self.process != None and self.process.poll() == None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+def supervise():
+    ring = SharedRing(slotCount=ringSlots)
+    gatewaySettings = gateway_settings()
+    children = [Child("ingest", [gatewaySettings] if gatewaySettings != None else []), Child("worker")]
+    signal.signal(signal.SIGTERM, lambda num, frame: sys.exit())
+    try:
+        while True:
+            for child in children:
+                child.check(ring.name)
+            time.sleep(checkIntervalSec)
+    finally:
+        for child in children:
+            child.stop() #SIGTERM, so the worker gets to flush its CSVs
+        ring.close()
+        ring.unlink()
+
+if __name__ == "__main__":
+    if len(sys.argv) in (3, 4) and sys.argv[1] == "ingest":
+        run_ingest(*sys.argv[2:])
+    elif len(sys.argv) == 3 and sys.argv[1] == "worker":
+        run_worker(sys.argv[2])
+    else:
+        supervise()
@@ -0,0 +1,74 @@
+import os
+import sqlite3
+
+import Metrics
+from GAPIHelper import SheetAppend
+from Log import log
+
+#Rows waiting to go up to sheets. Everything is queued here first so nothing is lost while the network is down,
+#and once it comes back the backlog goes up in bulk (Oldest first) instead of one request per row.
+scriptDir = os.path.dirname(os.path.realpath(__file__))
+outboxPath = scriptDir + "/Outbox.db"
+maxRows = 200000 #Oldest rows get dropped past this so an extended outage can't fill the SD card
+maxRowsPerAppend = 5000 #Keeps each sheet's append comfortably under the request size limit
+
+connection = None
+rowCount = 0
+
+def connect():
+    global connection, rowCount
+    if connection != None:
+        return connection
+    connection = sqlite3.connect(outboxPath)
+    with connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS outbox (fileName TEXT, folderName TEXT, timestamp REAL, headerLine TEXT, dataLine TEXT, PRIMARY KEY (fileName, timestamp))")
+        #Newest timestamp we know made it into each sheet. Lets replays skip rows that were already sent.
+        connection.execute("CREATE TABLE IF NOT EXISTS uploaded (fileName TEXT PRIMARY KEY, timestamp REAL)")
+    rowCount = connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+    return connection
+
+#Queuing the same (sensor, timestamp) twice, or one that has already been uploaded, does nothing.
+def enqueue(append:SheetAppend, timestamp:float):
+    global rowCount
+    db = connect()
+    with db:
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO outbox (fileName, folderName, timestamp, headerLine, dataLine) SELECT ?, ?, ?, ?, ? "
+            "WHERE NOT EXISTS (SELECT 1 FROM uploaded WHERE fileName = ? AND timestamp >= ?)",
+            (append.fileName, append.folderName, timestamp, append.headerLine, append.dataLine, append.fileName, timestamp))
+        rowCount += cursor.rowcount
+
+        if rowCount > maxRows:
+            cursor = db.execute("DELETE FROM outbox WHERE rowid IN (SELECT rowid FROM outbox ORDER BY timestamp LIMIT ?)", (rowCount - maxRows,))
+            log(f"Outbox is full, dropped the {cursor.rowcount} oldest rows")
+            rowCount -= cursor.rowcount
+
+#Returns fileName -> (SheetAppend holding every pending row for that sheet in order, timestamp of the newest row in it)
+def get_pending()->dict[str, tuple[SheetAppend, float]]:
+    pending = {}
+    rows = connect().execute(
+        "SELECT fileName, folderName, timestamp, headerLine, dataLine FROM "
+        "(SELECT *, ROW_NUMBER() OVER (PARTITION BY fileName ORDER BY timestamp) AS rowNum FROM outbox) "
+        "WHERE rowNum <= ? ORDER BY fileName, timestamp", (maxRowsPerAppend,))
+    for fileName, folderName, timestamp, headerLine, dataLine in rows:
+        if fileName not in pending:
+            pending[fileName] = (SheetAppend(headerLine, "", 0, folderName, fileName), timestamp)
+        append = pending[fileName][0]
+        append.headerLine = headerLine #The newest header wins if a sheet ever needs to be made
+        append.dataLine += dataLine
+        pending[fileName] = (append, timestamp)
+    return pending
+
+def mark_uploaded(fileName:str, throughTimestamp:float):
+    global rowCount
+    db = connect()
+    with db:
+        cursor = db.execute("DELETE FROM outbox WHERE fileName = ? AND timestamp <= ?", (fileName, throughTimestamp))
+        rowCount -= cursor.rowcount
+        db.execute("INSERT OR REPLACE INTO uploaded (fileName, timestamp) VALUES (?, ?)", (fileName, throughTimestamp))
+
+def pending_count():
+    connect()
+    return rowCount
+
+Metrics.collectors.append(lambda: [("gauge", "outbox_pending_rows", {}, rowCount)])
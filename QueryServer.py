@@ -0,0 +1,107 @@
+import asyncio
+import json
+import time
+from bisect import bisect_left
+from urllib.parse import parse_qs, urlsplit
+
+import ConfigManager as config
+import Metrics
+import RuuviPoller as ruuvi
+from Log import log
+
+#Tiny read only HTTP endpoint so things on the local network can get current conditions without going through Google.
+#  GET /latest                     -> Latest reading of every tag
+#  GET /history?mac=..&minutes=..  -> Recent readings (mac is optional, minutes defaults to 60)
+#  GET /metrics                    -> Prometheus text format, see Metrics
+historyResolutionSec = 60 #At most one reading per tag is kept per this many seconds
+historyWindowSec = 60 * 60 * 24
+
+historyTimes:dict[str, list[float]] = {} #mac -> timestamps (Sorted, so they can be searched)
+historyReadings:dict[str, list[dict]] = {}
+
+def to_json_fields(fields:dict):
+    if fields.get("temperature") != None:
+        fields["temperature"] = round(fields["temperature"] * 1.8 + 32, 2) #Same units as the CSVs and sheets
+    return fields
+
+def tag_name(mac:str):
+    cfg = config.tagConfigs.get(mac)
+    return cfg.name if cfg != None else ""
+
+#RuuviPoller subscriber
+def record_history(mac:str, data:ruuvi.RuuviData):
+    times = historyTimes.setdefault(mac, [])
+    if times and data.timestamp < times[-1] + historyResolutionSec:
+        return
+    readings = historyReadings.setdefault(mac, [])
+    times.append(data.timestamp)
+    readings.append(data.fields())
+
+    expired = bisect_left(times, data.timestamp - historyWindowSec)
+    if expired:
+        del times[:expired]
+        del readings[:expired]
+
+def get_latest():
+    now = time.time()
+    latest = {}
+    for mac, data in list(ruuvi.latestTagData.items()):
+        latest[mac] = {"name": tag_name(mac), "timestamp": data.timestamp, "ageSec": round(now - data.timestamp, 1), **to_json_fields(data.fields())}
+    return latest
+
+def get_history(macs:list[str], minutes:float):
+    since = time.time() - minutes * 60
+    history = {}
+    for mac in macs:
+        times = historyTimes.get(mac, [])
+        readings = historyReadings.get(mac, [])
+        start = bisect_left(times, since)
+        history[mac] = {"name": tag_name(mac), "readings": [{"timestamp": times[i], **to_json_fields(dict(readings[i]))} for i in range(start, len(times))]}
+    return history
+
+def route(path:str):
+    url = urlsplit(path)
+    query = parse_qs(url.query)
+    if url.path == "/latest":
+        return 200, get_latest()
+    if url.path == "/metrics":
+        return 200, Metrics.prometheus_text()
+    if url.path == "/history":
+        macs = query.get("mac", list(historyTimes.keys()))
+        try:
+            minutes = float(query.get("minutes", ["60"])[0])
+        except ValueError:
+            return 400, {"error": "minutes must be a number"}
+        return 200, get_history(macs, minutes)
+    return 404, {"error": f"Unknown path {url.path}. Try /latest, /history or /metrics"}
+
+async def handle_client(reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+    try:
+        requestLine = (await asyncio.wait_for(reader.readline(), 5)).decode("latin-1").split()
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass #Headers aren't needed
+
+        if len(requestLine) < 2 or requestLine[0] != "GET":
+            status, body = 405, {"error": "Only GET is supported"}
+        else:
+            status, body = route(requestLine[1])
+
+        contentType = "application/json"
+        if type(body) == str:
+            payload = body.encode()
+            contentType = "text/plain; version=0.0.4"
+        else:
+            payload = json.dumps(body).encode()
+        writer.write(f"HTTP/1.0 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: {contentType}\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode())
+        writer.write(payload)
+        await writer.drain()
+    except Exception as e:
+        log(f"QueryServer: {str(e)}")
+    finally:
+        writer.close()
+
+async def start(host:str, port:int):
+    ruuvi.advertisementSubscribers.append(record_history)
+    server = await asyncio.start_server(handle_client, host, port)
+    print(f"Serving tag readings on http://{host}:{port}/latest")
+    return server
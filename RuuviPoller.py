@@ -3,53 +3,207 @@ import asyncio
 import os
 os.environ["RUUVI_BLE_ADAPTER"] = "bleak"
 
+import struct
 from dataclasses import dataclass
 from datetime import datetime
 
-from ruuvitag_sensor.ruuvi import RuuviTagSensor
+from bleak import BleakScanner
+from ruuvitag_sensor.data_formats import DataFormats
+from ruuvitag_sensor.decoder import get_decoder
 
+import Metrics
+from Aggregator import TagWindow
 from Log import log
+from ScannerSupervisor import ScannerSupervisor
+
+#Decode data format 5 (RAWv2) ourselves, and only once the reading is actually used. Most advertisements get overwritten before then.
+#Other data formats (Or every format, with this off) still go through ruuvitag_sensor's decoders.
+fastDecode = True
+
+#Summarize every advertisement in a poll window (min/max/mean/count) instead of only keeping the latest one.
+#This adds columns, existing sheets will keep their old header row.
+aggregateWindows = False
+
+#Fields from ruuvitag_sensor we don't store
+unwantedHeaders = [
+        "acceleration",
+        "acceleration_x",
+        "acceleration_y",
+        "acceleration_z",
+        "tx_power",
+        "movement_counter",
+        "data_format",
+]
+
+#Undecoded data format 5 payload (hex, as ruuvitag_sensor hands it over). Values come out the same as ruuvitag_sensor's Df5Decoder.
+class Df5Reading:
+    __slots__ = ("payload",)
+    layout = struct.Struct(">BhHHhhhHBH6s") #format, temperature, humidity, pressure, acc x/y/z, power info, movement, sequence, mac
+
+    def __init__(self, payload:str):
+        self.payload = payload
+
+    def temperature(self)->float|None:
+        raw = int(self.payload[2:6], 16) #Just the bytes we need, this gets checked on every advertisement
+        if raw == 0x8000:
+            return None
+        if raw > 0x7FFF:
+            raw -= 0x10000
+        return round(raw / 200, 2)
+
+    #Gateway checks these on every advertisement from every source, so they also skip the full decode
+    def sequence(self)->int|None:
+        raw = int(self.payload[32:36], 16)
+        return None if raw == 0xFFFF else raw
+
+    def rssi(self)->int|None:
+        if len(self.payload) < 50:
+            return None
+        raw = int(self.payload[48:50], 16)
+        return raw - 256 if raw > 127 else raw
+
+    def as_dict(self)->dict:
+        (_, temperature, humidity, pressure, _, _, _, power, _, sequence, mac) = self.layout.unpack(bytes.fromhex(self.payload[:48]))
+        rssi = None
+        if len(self.payload) >= 50:
+            rssi = int(self.payload[48:50], 16)
+            if rssi > 127:
+                rssi -= 256
+        return {
+            "humidity": None if humidity == 0xFFFF else round(humidity / 400, 2),
+            "temperature": None if temperature == -0x8000 else round(temperature / 200, 2),
+            "pressure": None if pressure == 0xFFFF else round((pressure + 50000) / 100, 2),
+            "battery": None if (power >> 5) == 0x7FF else (power >> 5) + 1600,
+            "measurement_sequence_number": None if sequence == 0xFFFF else sequence,
+            "mac": mac.hex(),
+            "rssi": rssi,
+        }
 
 @dataclass
 class RuuviData:
     timestamp:int
-    data:dict
+    data:dict|Df5Reading
+
+    #The decoded values we actually keep. Returns a new dict each time so it is safe to modify.
+    def fields(self)->dict:
+        if type(self.data) == Df5Reading:
+            return self.data.as_dict()
+        return {key: value for key, value in self.data.items() if key not in unwantedHeaders}
+
+    #Celsius
+    def temperature(self)->float|None:
+        if type(self.data) == Df5Reading:
+            return self.data.temperature()
+        return self.data.get("temperature")
+
+macBlacklist = [] #Devices which aren't RuuviTags, scan_tags skips these before decoding anything.
+
+def make_scanner(onDetection, adapter:str):
+    if adapter:
+        return BleakScanner(detection_callback=onDetection, adapter=adapter)
+    return BleakScanner(detection_callback=onDetection)
+
+#Yields (mac, dict or Df5Reading) for every RuuviTag advertisement. adapter is the bluetooth device ("hci1" for example), "" for the default one.
+#The BleakScanner is ours rather than ruuvitag_sensor's get_data's, which only stops its scanner when closed at a yield. Cancelled while
+#waiting for an advertisement (How ScannerSupervisor tears down a stalled scanner) it left the scanner running. Ours stops however it ends.
+async def scan_tags(whitelist, adapter:str = ""):
+    advertisements = asyncio.Queue()
+    def on_detection(device, advertisementData):
+        mac = device.address
+        if mac in macBlacklist or (whitelist and mac not in whitelist):
+            return
+        manufacturerData = advertisementData.manufacturer_data.get(0x0499) #Ruuvi Innovations
+        if manufacturerData == None:
+            return
+        #Same layout ruuvitag_sensor's bleak adapter hands to DataFormats.convert_data: lengths, FF type, 9904 manufacturer, data, rssi
+        rawData = f"FF9904{manufacturerData.hex()}"
+        rawData = f"{len(rawData) >> 1:02x}{rawData}"
+        rawData = f"{len(rawData) >> 1:02x}{rawData}"
+        if advertisementData.rssi:
+            rawData += f"{advertisementData.rssi & 0xFF:02x}"
+        advertisements.put_nowait((mac, rawData))
+
+    scanner = make_scanner(on_detection, adapter)
+    await scanner.start()
+    try:
+        while True:
+            mac, rawData = await advertisements.get()
+            (dataFormat, payload) = DataFormats.convert_data(rawData)
+            if dataFormat == None or payload == None:
+                if dataFormat == None and mac not in macBlacklist:
+                    macBlacklist.append(mac)
+                continue
+            if dataFormat == 5 and fastDecode:
+                if len(payload) >= 48: #Truncated ones would only fail later, when the reading gets used (ruuvitag_sensor skips them too)
+                    yield mac, Df5Reading(payload)
+                continue
+            decoded = get_decoder(dataFormat).decode_data(payload)
+            if decoded != None:
+                yield mac, decoded
+    finally:
+        await scanner.stop()
 
 #Tag whitelist
-lastTagCheckIn = {}
+lastTagCheckIn = {} #mac -> timestamp of its latest advertisement, TimeoutMonitor works off of this
 activeTagData:dict[str, RuuviData] = {}
+latestTagData:dict[str, RuuviData] = {} #Unlike activeTagData, this never gets cleared
+advertisementCounts:dict[str, int] = {} #mac -> advertisements since startup, for Metrics
+activeTagWindows:dict[str, TagWindow] = {}
 tagDataSem = asyncio.Semaphore()
-async def polltags(whitelist):
-    while(1):
-        generator = RuuviTagSensor.get_data_async(macs=whitelist)
+#Called with (mac, RuuviData) for every advertisement as it comes in. These run inline with polling so they need to be quick.
+advertisementSubscribers = []
+scannerSupervisor = ScannerSupervisor()
+#timestamp is when it was heard, now if not given
+async def record_advertisement(mac:str, data:dict|Df5Reading, timestamp:float = None):
+    if timestamp == None:
+        timestamp = datetime.timestamp(datetime.now())
+    advertisementCounts[mac] = advertisementCounts.get(mac, 0) + 1
+    ruuviData = RuuviData(timestamp, data)
+    fields = ruuviData.fields() if aggregateWindows else None
+    async with tagDataSem:
+        #Always overwrite the old data because we only care about the latest.
+        activeTagData[mac] = ruuviData
+        latestTagData[mac] = ruuviData
+        lastTagCheckIn[mac] = timestamp
+        if fields != None:
+            if mac not in activeTagWindows:
+                activeTagWindows[mac] = TagWindow()
+            activeTagWindows[mac].add(fields)
+    for subscriber in advertisementSubscribers:
         try:
-            generator = RuuviTagSensor.get_data_async(macs=whitelist)
-            async for found_data in generator: #TODO: Need a way to gracefully break out of this. anext half worked.
-                mac = found_data[0]
-                timestamp = datetime.timestamp(datetime.now())
-                async with tagDataSem:
-                    #Always overwrite the old data because we only care about the latest.
-                    activeTagData[mac] = RuuviData(timestamp, found_data[1])
-                    lastTagCheckIn[mac] = timestamp
+            subscriber(mac, ruuviData)
         except Exception as e:
-            if type(e) ==  StopAsyncIteration:
-                log("Generator terminated unexpectedly.")
-                del(generator) #This doesn't actually stop the previous subprocess.
-            else:
-                log("polltags: %s" % str(e))
+            log(f"polltags subscriber {subscriber.__name__}: {str(e)}")
 
+#Cancelling this stops the scanner too, see ScannerSupervisor
+async def polltags(whitelist):
+    await scannerSupervisor.run(lambda: scan_tags(whitelist), record_advertisement)
 
+def advertisement_metrics():
+    return [("counter", "advertisements_total", {"mac": mac}, total) for mac, total in list(advertisementCounts.items())]
+
+Metrics.collectors.append(advertisement_metrics)
 
 async def minutes_since_last_checkin(mac:str)->float|None:
     async with tagDataSem:
         if mac in lastTagCheckIn:
             return((datetime.timestamp(datetime.now()) - lastTagCheckIn[mac])/60)
         else:
-            None
+            return None
 
-async def getLatestData()->dict[str, RuuviData]:
+#Hands over (And starts a new window for) just the tags in macs, or every tag if macs is None
+async def getLatestData(macs:list[str] = None)->dict[str, RuuviData]:
     async with tagDataSem:
-        tagData = activeTagData.copy()
-        activeTagData.clear()
+        if macs == None:
+            tagData = activeTagData.copy()
+            activeTagData.clear()
+            tagWindows = activeTagWindows.copy()
+            activeTagWindows.clear()
+        else:
+            tagData = {mac: activeTagData.pop(mac) for mac in macs if mac in activeTagData}
+            tagWindows = {mac: activeTagWindows.pop(mac) for mac in macs if mac in activeTagWindows}
 
+    for mac, window in tagWindows.items():
+        if mac in tagData:
+            tagData[mac] = RuuviData(tagData[mac].timestamp, window.summary())
     return tagData
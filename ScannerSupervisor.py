@@ -0,0 +1,122 @@
+import asyncio
+import os
+import time
+
+import Metrics
+from Log import log
+
+#Owns the BLE scanner (An async generator from RuuviPoller.scan_tags). Only one scanner exists at a time, and before another is started
+#the old one is torn down for certain: the task reading it is cancelled and awaited, which runs the generator's cleanup (Stopping the
+#bleak scanner), then it is closed. A scanner that ends, fails, or goes stallSec without an advertisement is restarted with backoff.
+#Open fds, threads and child processes are logged after every restart so anything a scanner leaves behind shows up as growth.
+
+stallSec = 120 #No advertisements for this long restarts the scanner
+minRestartDelaySec = 1
+maxRestartDelaySec = 60 * 10
+teardownTimeoutSec = 10
+
+def count_entries(path:str):
+    try:
+        return len(os.listdir(path))
+    except OSError:
+        return None
+
+def count_child_processes():
+    children = 0
+    try:
+        for thread in os.listdir("/proc/self/task"):
+            with open(f"/proc/self/task/{thread}/children", 'r') as childList:
+                children += len(childList.read().split())
+    except OSError:
+        return None
+    return children
+
+def resource_usage():
+    return {"fds": count_entries("/proc/self/fd"), "threads": count_entries("/proc/self/task"), "children": count_child_processes()}
+
+class ScannerSupervisor:
+    def __init__(self, name:str = "scanner"):
+        self.name = name
+        self.restarts = 0
+        self.startTime = 0.0
+        self.lastAdvertTime = 0.0
+        self.firstAdvertSec = None
+        self.restartDelaySec = minRestartDelaySec
+        self.baseline = None
+
+    async def consume(self, scanner, onAdvertisement):
+        async for advertisement in scanner:
+            self.lastAdvertTime = time.monotonic()
+            if self.firstAdvertSec == None:
+                self.firstAdvertSec = self.lastAdvertTime - self.startTime
+                self.restartDelaySec = minRestartDelaySec #Working again, a later failure starts the backoff over
+                Metrics.set_gauge("scanner_time_to_first_advertisement_seconds", self.firstAdvertSec, scanner=self.name)
+                if self.restarts:
+                    log(f"{self.name} restart {self.restarts}: first advertisement after {self.firstAdvertSec:.1f}s")
+            await onAdvertisement(*advertisement)
+
+    #Waits until the scanner ends, fails or stalls. Returns why.
+    async def watch(self, task:asyncio.Task):
+        while True:
+            silentSec = time.monotonic() - max(self.lastAdvertTime, self.startTime)
+            done, _ = await asyncio.wait([task], timeout=max(stallSec - silentSec, 1))
+            if done:
+                error = task.exception()
+                return f"failed: {str(error)}" if error != None else "ended"
+            if time.monotonic() - max(self.lastAdvertTime, self.startTime) >= stallSec:
+                return f"stalled, no advertisements in {stallSec}s"
+
+    #Cancelling the reading task is what runs the generator's cleanup (Stopping the scanner). If we get cancelled ourselves in the
+    #meantime, the scanner is still stopped first and then the cancellation is passed on.
+    async def teardown(self, task:asyncio.Task, scanner):
+        task.cancel()
+        cancelled = False
+        deadline = time.monotonic() + teardownTimeoutSec
+        while not task.done() and time.monotonic() < deadline:
+            try:
+                await asyncio.wait([task], timeout=deadline - time.monotonic()) #Unlike wait_for, doesn't cancel the task again
+            except asyncio.CancelledError:
+                cancelled = True
+        if task.done() and not task.cancelled() and task.exception() != None:
+            log(f"{self.name} teardown: {str(task.exception())}")
+        try:
+            await asyncio.wait_for(scanner.aclose(), teardownTimeoutSec)
+        except asyncio.CancelledError:
+            cancelled = True
+        except Exception as e:
+            log(f"{self.name} close: {str(e)}")
+        if cancelled:
+            raise(asyncio.CancelledError())
+
+    def report_resources(self):
+        usage = resource_usage()
+        if self.baseline == None:
+            self.baseline = usage
+        for resource, value in usage.items():
+            if value != None:
+                Metrics.set_gauge(f"process_{resource}", value)
+        growth = {resource: value - self.baseline[resource] for resource, value in usage.items() if value != None and self.baseline[resource] != None}
+        log(f"{self.name} restart {self.restarts}: {usage} (Since the first start: {growth})")
+
+    #Runs scanners from scannerFactory() forever, awaiting onAdvertisement(mac, data) for each advertisement. Scanners that know when
+    #an advertisement was heard yield (mac, data, timestamp), and that goes to onAdvertisement too.
+    async def run(self, scannerFactory, onAdvertisement):
+        while True:
+            if self.restarts:
+                self.report_resources()
+            else:
+                self.baseline = resource_usage()
+            scanner = scannerFactory()
+            self.startTime = time.monotonic()
+            self.firstAdvertSec = None
+            task = asyncio.create_task(self.consume(scanner, onAdvertisement))
+            try:
+                reason = await self.watch(task)
+            finally:
+                await self.teardown(task, scanner) #Also when we are cancelled, so a scanner never outlives its supervisor
+
+            self.restarts += 1
+            Metrics.count("scanner_restarts_total", scanner=self.name)
+            log(f"{self.name} {reason}, restarting in {self.restartDelaySec}s")
+            await asyncio.sleep(self.restartDelaySec)
+            self.restartDelaySec = min(self.restartDelaySec * 2, maxRestartDelaySec)
@@ -0,0 +1,104 @@
+import asyncio
+import math
+import time
+
+import ConfigManager as config
+from ConfigManager import RuuviConfig
+from RuuviPoller import RuuviData
+
+#Gives every tag its own logging/upload cadence. A tag near (Or past) its thresholds, or changing quickly, is logged every fastIntervalSec,
+#everything else every slowIntervalSec. Due times are multiples of the interval on the system clock (Like pollEvery_thMinute always was),
+#worked out from the clock each time rather than by adding up sleeps, so oversleeping never accumulates into drift.
+
+adaptive = False #Off: every tag is on the slow cadence, which is the same as the old single poll
+slowIntervalSec = 5 * 60 #Set by main from pollEvery_thMinute
+fastIntervalSec = 30
+nearThresholdF = 2.0 #Within this many degrees of a threshold counts as near
+fastChangeFPerMin = 0.2 #Changing at least this fast counts as fast
+
+nextDue:dict[str, float] = {} #mac -> when it is next logged
+intervals:dict[str, float] = {} #mac -> its current interval
+lastLogged:dict[str, tuple[float, float]] = {} #mac -> (timestamp, temperatureF) of the last reading it was scheduled from
+nextSlowTick = 0.0
+scheduleChanged = asyncio.Event() #Wakes sleep_until when a tag gets pulled forward
+
+def align(now:float, intervalSec:float):
+    return (math.floor(now / intervalSec) + 1) * intervalSec
+
+#Returns at wakeTime, or early if the schedule changed (Work out the next wakeup again either way)
+async def sleep_until(wakeTime:float):
+    scheduleChanged.clear()
+    while True:
+        remaining = wakeTime - time.time()
+        if remaining <= 0:
+            return
+        try:
+            await asyncio.wait_for(scheduleChanged.wait(), remaining)
+            return
+        except asyncio.TimeoutError:
+            pass #Loops in case the clock was adjusted while we slept
+
+def track(mac:str, now:float):
+    if mac not in nextDue:
+        nextDue[mac] = align(now, slowIntervalSec)
+        intervals[mac] = slowIntervalSec
+
+def next_wakeup(now:float):
+    if not nextDue:
+        return align(now, slowIntervalSec)
+    return max(min(nextDue.values()), now)
+
+def due_macs(now:float):
+    return [mac for mac, dueTime in nextDue.items() if dueTime <= now]
+
+#True once per slow interval, for work that doesn't need to happen on every fast tick (Config sync for example)
+def slow_tick_due(now:float):
+    global nextSlowTick
+    if now < nextSlowTick:
+        return False
+    nextSlowTick = align(now, slowIntervalSec)
+    return True
+
+def near_threshold(temperatureF:float, cfg:RuuviConfig):
+    return temperatureF <= cfg.lowerThresholdF + nearThresholdF or temperatureF >= cfg.upperThresholdF - nearThresholdF
+
+def choose_interval(mac:str, data:RuuviData, cfg:RuuviConfig):
+    if not adaptive:
+        return slowIntervalSec
+    temperatureC = data.temperature()
+    if temperatureC == None:
+        return slowIntervalSec
+    temperatureF = temperatureC * 1.8 + 32
+
+    previous = lastLogged.get(mac)
+    lastLogged[mac] = (data.timestamp, temperatureF)
+    if near_threshold(temperatureF, cfg):
+        return fastIntervalSec
+    if previous != None and data.timestamp > previous[0]:
+        changeFPerMin = abs(temperatureF - previous[1]) / ((data.timestamp - previous[0]) / 60)
+        if changeFPerMin >= fastChangeFPerMin:
+            return fastIntervalSec
+    return slowIntervalSec
+
+#data is None when the tag wasn't heard from, it stays on the cadence it was on
+def reschedule(mac:str, data:RuuviData, cfg:RuuviConfig, now:float):
+    if data != None:
+        intervals[mac] = choose_interval(mac, data, cfg)
+    nextDue[mac] = align(now, intervals.get(mac, slowIntervalSec))
+
+#RuuviPoller subscriber. A slow tag that drifts near a threshold is pulled forward to the next fast tick instead of waiting out its interval.
+def on_advertisement(mac:str, data:RuuviData):
+    if not adaptive or intervals.get(mac) != slowIntervalSec:
+        return
+    cfg = config.tagConfigs.get(mac)
+    temperatureC = data.temperature()
+    if cfg == None or temperatureC == None or not near_threshold(temperatureC * 1.8 + 32, cfg):
+        return
+    intervals[mac] = fastIntervalSec
+    nextDue[mac] = min(nextDue[mac], align(data.timestamp, fastIntervalSec))
+    scheduleChanged.set()
+
+def forget(mac:str):
+    nextDue.pop(mac, None)
+    intervals.pop(mac, None)
+    lastLogged.pop(mac, None)
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+from RuuviPoller import Df5Reading, unwantedHeaders
+
+#Fixed size ring of advertisements in shared memory, written by the ingest process and read by the worker (See MultiProcess).
+#One writer and one reader, no locks. Every slot has a sequence number which is odd while the writer is partway through it
+#(A seqlock), so the reader can tell when a slot was overwritten under it. Data format 5 goes in as the raw 24 byte payload (+ rssi),
+#anything else as json without the fields we don't store (A decoded data format 5 reading comes to about 140 bytes that way). The reader's position is kept in the ring too, so a restarted worker picks up where the last one stopped.
+#A reader that falls more than a whole ring behind skips ahead and counts what it lost.
+
+defaultSlotCount = 4096
+slotSize = 256
+
+header = struct.Struct("<QQII") #Advertisements written so far, advertisements read so far, slot count, slot size
+slotHeader = struct.Struct("<Qd6sBB") #Sequence, timestamp, mac, kind, payload length
+kindJson = 0
+kindDf5 = 5
+maxPayload = slotSize - slotHeader.size
+
+def mac_to_bytes(mac:str):
+    return bytes.fromhex(mac.replace(":", ""))
+
+def bytes_to_mac(macBytes:bytes):
+    return ":".join(f"{byte:02X}" for byte in macBytes)
+
+class SharedRing:
+    def __init__(self, name:str = None, slotCount:int = defaultSlotCount):
+        if name == None:
+            self.memory = shared_memory.SharedMemory(create=True, size=header.size + slotCount * slotSize)
+            header.pack_into(self.memory.buf, 0, 0, 0, slotCount, slotSize)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            #Otherwise this process's resource tracker unlinks the ring when it exits, taking it away from everyone else. The supervisor owns it.
+            resource_tracker.unregister(self.memory._name, "shared_memory")
+        self.name = self.memory.name
+        self.buffer = self.memory.buf
+        _, self.readPosition, self.slotCount, storedSlotSize = header.unpack_from(self.buffer, 0)
+        if storedSlotSize != slotSize:
+            raise(Exception(f"Shared ring {self.name} has {storedSlotSize} byte slots, expected {slotSize}"))
+        self.lost = 0
+
+    def write_count(self):
+        return header.unpack_from(self.buffer, 0)[0]
+
+    def slot_offset(self, position:int):
+        return header.size + (position % self.slotCount) * slotSize
+
+    #Writer side. Returns False if the advertisement doesn't fit in a slot.
+    def write(self, timestamp:float, mac:str, data:dict|Df5Reading):
+        if type(data) == Df5Reading:
+            kind, payload = kindDf5, bytes.fromhex(data.payload)
+        else:
+            kept = {key: value for key, value in data.items() if key not in unwantedHeaders}
+            kind, payload = kindJson, json.dumps(kept, separators=(",", ":")).encode()
+        if len(payload) > maxPayload:
+            return False
+
+        position = self.write_count()
+        offset = self.slot_offset(position)
+        struct.pack_into("<Q", self.buffer, offset, 2 * position + 1) #Odd, readers leave it alone until it is done
+        slotHeader.pack_into(self.buffer, offset, 2 * position + 1, timestamp, mac_to_bytes(mac), kind, len(payload))
+        self.buffer[offset + slotHeader.size:offset + slotHeader.size + len(payload)] = payload
+        struct.pack_into("<Q", self.buffer, offset, 2 * position + 2)
+        struct.pack_into("<Q", self.buffer, 0, position + 1)
+        return True
+
+    #Reader side. Returns [(timestamp, mac, dict or Df5Reading)] for everything written since the last read.
+    def read_new(self):
+        readings = []
+        writeCount = self.write_count()
+        if writeCount - self.readPosition > self.slotCount:
+            self.lost += writeCount - self.slotCount - self.readPosition
+            self.readPosition = writeCount - self.slotCount
+
+        while self.readPosition < writeCount:
+            position = self.readPosition
+            offset = self.slot_offset(position)
+            sequence, timestamp, macBytes, kind, length = slotHeader.unpack_from(self.buffer, offset)
+            payload = bytes(self.buffer[offset + slotHeader.size:offset + slotHeader.size + length])
+            if sequence != 2 * position + 2 or struct.unpack_from("<Q", self.buffer, offset)[0] != sequence:
+                self.lost += 1 #Overwritten while we were reading it, we are too far behind
+            elif kind == kindDf5:
+                readings.append((timestamp, bytes_to_mac(macBytes), Df5Reading(payload.hex())))
+            else:
+                readings.append((timestamp, bytes_to_mac(macBytes), json.loads(payload)))
+            self.readPosition += 1
+        struct.pack_into("<Q", self.buffer, 8, self.readPosition)
+        return readings
+
+    #Stands in for RuuviPoller.scan_tags in the worker process. Also yields when the ingest process heard each advertisement, so ones
+    #buffered while the worker was restarting don't all get stamped with the time it caught up.
+    async def scan_tags(self, whitelist, pollSec:float = 0.05):
+        while True:
+            for timestamp, mac, data in self.read_new():
+                if not whitelist or mac in whitelist:
+                    yield mac, data, timestamp
+            await asyncio.sleep(pollSec)
+
+    def close(self):
+        self.buffer = None
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
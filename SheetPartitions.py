@@ -0,0 +1,118 @@
+import json
+import os
+import time
+from datetime import datetime
+
+import GAPIAsync
+import GAPIHelper as gapi
+from Log import log
+
+#Splits each sensor's sheet into one spreadsheet per month or year, or every partitionMaxRows rows, so no sheet grows forever.
+#The next partition (Header and all) is made ahead of time by prepare_next_partitions, so rolling over mid cycle is only a new fileName.
+#Time partitions go by each row's own timestamp, so rows caught up from the outbox still land in the right sheet.
+scriptDir = os.path.dirname(os.path.realpath(__file__))
+indexPath = scriptDir + "/SheetPartitions.json"
+partitionMode = None #None (One sheet per sensor like before), "month", "year" or "rows"
+partitionMaxRows = 200000 #Used by "rows"
+createAheadSec = 60 * 60 * 24 #Time partitions are made this long before they start
+createAtFraction = 0.9 #Row partitions are made once the current one is this full
+
+#sensorId -> {"folder", "header", "part", "rows", "files": {partition sheet name -> fileId (None until it is known)}}
+index:dict[str, dict] = None
+sheetOwners:dict[str, str] = {} #Partition sheet name -> sensorId
+indexDirty = False
+
+def load_index():
+    global index
+    if index != None:
+        return index
+    index = {}
+    try:
+        with open(indexPath, 'r') as indexFile:
+            index = json.load(indexFile)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log(f"Unable to read {indexPath}, partitions will be rediscovered: {str(e)}")
+    for sensorId, entry in index.items():
+        for sheetName in entry["files"]:
+            sheetOwners[sheetName] = sensorId
+    return index
+
+def save_index():
+    global indexDirty
+    try:
+        with open(indexPath + ".tmp", 'w') as indexFile:
+            json.dump(index, indexFile, indent=1)
+        os.replace(indexPath + ".tmp", indexPath)
+        indexDirty = False
+    except Exception as e:
+        log(f"Unable to save {indexPath}: {str(e)}")
+
+def time_partition(sensorId:str, timestamp:float):
+    moment = datetime.fromtimestamp(timestamp)
+    if partitionMode == "year":
+        return f"{sensorId} {moment.year}"
+    return f"{sensorId} {moment.year}-{moment.month:02d}"
+
+def rows_partition(sensorId:str, part:int):
+    return f"{sensorId} part {part}"
+
+def add_partition(sensorId:str, sheetName:str, fileId:str = None):
+    global indexDirty
+    files = index[sensorId]["files"]
+    if sheetName not in files or (fileId and files[sheetName] != fileId):
+        files[sheetName] = fileId
+        sheetOwners[sheetName] = sensorId
+        indexDirty = True
+
+#Sheet name that a row from sensorId at timestamp goes into
+def sheet_name(sensorId:str, folderName:str, headerLine:str, timestamp:float, rowCount:int = 1):
+    global indexDirty
+    if partitionMode == None:
+        return sensorId
+
+    entry = load_index().setdefault(sensorId, {"part": 1, "rows": 0, "files": {}})
+    before = (entry.get("folder"), entry.get("header"), entry["part"], entry["rows"])
+    entry["folder"] = folderName
+    entry["header"] = headerLine #Newest header wins for partitions made ahead of time
+    if partitionMode == "rows":
+        if entry["rows"] + rowCount > partitionMaxRows:
+            entry["part"] += 1
+            entry["rows"] = 0
+        entry["rows"] += rowCount
+        name = rows_partition(sensorId, entry["part"])
+    else:
+        name = time_partition(sensorId, timestamp)
+    add_partition(sensorId, name)
+    if (entry["folder"], entry["header"], entry["part"], entry["rows"]) != before:
+        indexDirty = True #Only then, otherwise the index gets rewritten to the SD card every cycle for nothing
+    return name
+
+#Called with every fileId an upload ends up using, which keeps the index right when a sheet is remade after being deleted
+def record_file_id(sheetName:str, fileId:str):
+    if partitionMode == None or sheetName not in sheetOwners:
+        return
+    add_partition(sheetOwners[sheetName], sheetName, fileId)
+
+def next_partition(sensorId:str, entry:dict):
+    if partitionMode == "rows":
+        if entry["rows"] < partitionMaxRows * createAtFraction:
+            return None
+        return rows_partition(sensorId, entry["part"] + 1)
+    return time_partition(sensorId, time.time() + createAheadSec)
+
+async def prepare_next_partitions():
+    if partitionMode == None:
+        return
+    for sensorId, entry in list(load_index().items()):
+        name = next_partition(sensorId, entry)
+        if name == None or entry["files"].get(name) or "header" not in entry:
+            continue
+        try:
+            fileId = await GAPIAsync.call(gapi.make_sheet_if_dne, entry["header"], entry["folder"], name)
+            add_partition(sensorId, name, fileId)
+        except Exception as e:
+            log(f"Unable to make the next sheet partition {name}: {str(e)}") #Not fatal, the upload will make it if it comes to that
+    if indexDirty:
+        save_index()
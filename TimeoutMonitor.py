@@ -0,0 +1,83 @@
+import asyncio
+import heapq
+import time
+
+import ConfigManager as config
+import EmailHandler
+import RuuviPoller as ruuvi
+from Log import log
+
+#Notices tags that stop checking in as soon as their deadline passes instead of scanning every tag each poll.
+#The heap holds (deadline, mac) and isn't touched on check in. polltags only updates ruuvi.lastTagCheckIn, and when an entry comes due
+#it is compared against the latest check in and pushed back with the real deadline if the tag has been heard from since (Lazy reinsertion).
+#So the work done is per deadline that comes due, at most one per tag per timeoutSec, no matter how many tags or advertisements there are.
+#A timed out tag is checked again retrySec later, or repeatSec later once its email has actually gone out (alert_sent).
+
+timeoutSec = 30 * 60 #Set by main
+repeatSec = 60 * 60 * 24 #A tag that stays silent is checked again this much after its email went out. Set by main to match its email rate limit.
+retrySec = 5 * 60 #...or this much later if the email couldn't be sent. Set by main.
+startTime = time.time() #Tags that never checked in are timed from here. Set by main.
+onTimeout = None #onTimeout(mac, minutesSinceCheckin, sensorName, neverCheckedIn), queues the email. Set by main.
+
+deadlines:list[tuple[float, str]] = []
+deadlineOf:dict[str, float] = {} #mac -> its current deadline. Heap entries with any other deadline have been replaced and are skipped.
+trackedMacs = set()
+deadlinesChanged = asyncio.Event() #Wakes the watcher when a new deadline might be sooner than the one it is sleeping on
+
+def track(mac:str):
+    if mac in trackedMacs:
+        return
+    trackedMacs.add(mac)
+    push(mac, ruuvi.lastTagCheckIn.get(mac, startTime) + timeoutSec)
+    deadlinesChanged.set()
+
+def push(mac:str, deadline:float):
+    deadlineOf[mac] = deadline
+    heapq.heappush(deadlines, (deadline, mac))
+
+#Called once a timeout email has gone out
+def alert_sent(mac:str, sentTime:float):
+    if mac in trackedMacs:
+        push(mac, sentTime + repeatSec)
+
+#Handles every deadline that has come due. Returns how many tags actually timed out.
+def process_due(now:float):
+    timedOut = 0
+    while deadlines and deadlines[0][0] <= now:
+        deadline, mac = heapq.heappop(deadlines)
+        if deadlineOf.get(mac) != deadline:
+            continue
+        cfg = config.tagConfigs.get(mac)
+        if cfg == None or not cfg.enabled:
+            trackedMacs.discard(mac) #Picked up again by track() if it is turned back on
+            del deadlineOf[mac]
+            continue
+
+        lastCheckin = ruuvi.lastTagCheckIn.get(mac)
+        if lastCheckin != None and lastCheckin + timeoutSec > now:
+            push(mac, lastCheckin + timeoutSec) #Heard from since this was pushed
+            continue
+
+        neverCheckedIn = lastCheckin == None
+        minutesSince = (now - (startTime if neverCheckedIn else lastCheckin)) / 60
+        try:
+            onTimeout(mac, minutesSince, cfg.name, neverCheckedIn)
+            timedOut += 1
+        except Exception as e:
+            log(f"TimeoutMonitor: {str(e)}")
+        push(mac, now + retrySec) #Pushed back to repeatSec by alert_sent if the email goes out
+    return timedOut
+
+async def watch_timeouts():
+    while True:
+        deadlinesChanged.clear()
+        waitSec = deadlines[0][0] - time.time() if deadlines else None
+        if waitSec == None or waitSec > 0:
+            try:
+                await asyncio.wait_for(deadlinesChanged.wait(), waitSec)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        if process_due(time.time()):
+            await EmailHandler.send_digest() #Everything that timed out together goes out together
@@ -3,9 +3,19 @@ import os
 import time
 import signal
 
+import AlertMonitor
+import Compression
 import EmailHandler
-import GAPIHelper
+import Gateway
+import GAPIAsync
+import HistoryWriter
 import Log
+import Metrics
+import Outbox
+import QueryServer
+import Scheduler
+import SheetPartitions
+import TimeoutMonitor
 
 import ConfigManager as config
 import RuuviPoller as ruuvi
@@ -21,6 +31,17 @@ scriptDir = os.path.dirname(os.path.realpath(__file__))
 #-------------------------------
 pollEvery_thMinute = 5 #Example: 10 = Poll at 3:00, 3:10, 3:20, 3:30, etc. Not well tested.
 
+adaptiveSampling = False #Log and upload tags near their thresholds (Or changing quickly) every fastPollSec instead of every pollEvery_thMinute
+fastPollSec = 30
+
+compressionMethod = None #None logs every reading. "deadband" or "swinging_door" only logs readings that moved more than Compression.tolerances
+compressionHeartbeatSec = 60 * 60 #A row is logged at least this often even if nothing changed
+
+multiProcess = False #Run BLE ingest in its own process, feeding this one through shared memory. See MultiProcess.
+
+gatewayAdapters = [""] #Bluetooth adapters to scan with, "" is the default one. ["hci0", "hci1"] merges both, see Gateway.
+gatewayListen = None #"host:port" or a unix socket path where remote gateways (python3 Gateway.py forward <address>) send their advertisements
+
 emailAlertTimeoutHr = 5 # Send an email every x hours until the temperature goes back within bounds.
 
 tagTimeoutTimeMin = 30 # Notify when tag has not checked in after x minutes
@@ -30,30 +51,64 @@ timeoutEmailDelayTimeSec = 60 * 60 * 24 #Timeout emails can be sent only once ev
 uploadErrorLogIntervalSec = 60 * 60 #Put the error log into drives once every hour
 
 debugMode = False #Set this if you want to ensure that you are not actually sending emails while testing
+
+csvFlushIntervalSec = 60 * 15 #Local CSV rows are buffered and written to the SD card together at most this often
+csvFlushRowCount = 200 #...or once this many rows are waiting
+csvFsyncPolicy = "commit" #"never", "commit" (fsync every flush) or "always" (write and fsync every row)
+
+aggregateWindows = False #Log min/max/mean/count of every advertisement between polls instead of just the latest. Adds columns.
+
+queryServerHost = "127.0.0.1" #Use "0.0.0.0" to let other machines on the network read current conditions
+queryServerPort = 8080 #Set to None to turn the local JSON endpoint off
+
+uploadRetryDelaySec = 60 * 10 #After a cycle where no upload got through, uploads wait this long (Doubling up to uploadRetryMaxSec). Rows keep being logged and queued.
+uploadRetryMaxSec = 60 * 60
+
+statsIntervalSec = 60 #How often Stats.json gets rewritten with the current metrics
+
+sheetPartitionMode = None #None keeps one sheet per sensor. "month" or "year" starts a new sheet per sensor every month/year, "rows" every sheetPartitionMaxRows rows
+sheetPartitionMaxRows = 200000
 #-------------------------------
 
 EmailHandler.debugOnly = debugMode
-
-initFailCount = 0
-while True:
-    try:
-        if GAPIHelper.get_valid_token():
-            break
-    except:
-        initFailCount += 1
-        time.sleep(5 * min(initFailCount, 60)) #Back off to a maximum of retry every 5 minutes
+HistoryWriter.flushIntervalSec = csvFlushIntervalSec
+HistoryWriter.flushRowCount = csvFlushRowCount
+HistoryWriter.fsyncPolicy = csvFsyncPolicy
+ruuvi.aggregateWindows = aggregateWindows
+Metrics.statsIntervalSec = statsIntervalSec
+SheetPartitions.partitionMode = sheetPartitionMode
+SheetPartitions.partitionMaxRows = sheetPartitionMaxRows
+Scheduler.adaptive = adaptiveSampling
+Compression.method = compressionMethod
+Compression.heartbeatSec = compressionHeartbeatSec
+Scheduler.slowIntervalSec = pollEvery_thMinute * 60
+Scheduler.fastIntervalSec = fastPollSec
+TimeoutMonitor.timeoutSec = tagTimeoutTimeMin * 60
+TimeoutMonitor.repeatSec = timeoutEmailDelayTimeSec
+TimeoutMonitor.retrySec = pollEvery_thMinute * 60 #Like the old check, which ran every poll
+TimeoutMonitor.startTime = programStartTime
+Gateway.localAdapters = gatewayAdapters
+Gateway.listenAddress = gatewayListen
+if gatewayAdapters != [""] or gatewayListen != None:
+    ruuvi.scan_tags = Gateway.scan_tags
 
 config.load_local_file()
 
 #TODO: Consider combining into a class
 lastTimeoutEmailDict = {}
+nextUploadTime = 0.0
+uploadFailures = 0
 ruuviTagDataHandler:dict[str, DataHandler] = {}
 for mac, cfg in config.tagConfigs.items():
     lastTimeoutEmailDict[mac] = float('-inf')
     ruuviTagDataHandler[mac] = DataHandler(mac, emailAlertTimeoutHr)
 
+AlertMonitor.dataHandlers = ruuviTagDataHandler
+ruuvi.advertisementSubscribers.append(AlertMonitor.on_advertisement)
+ruuvi.advertisementSubscribers.append(Scheduler.on_advertisement)
+
 def send_timeout_alert(mac, lastCheckinTimeMin:float, sensorName:str, neverCheckedIn:bool):
-    if time.time() < lastTimeoutEmailDict[mac] + timeoutEmailDelayTimeSec:
+    if time.time() < lastTimeoutEmailDict.get(mac, float('-inf')) + timeoutEmailDelayTimeSec:
         return #Prevent email spam when the tag hasn't checked in
 
     message = ""
@@ -62,76 +117,167 @@ def send_timeout_alert(mac, lastCheckinTimeMin:float, sensorName:str, neverCheck
     else:
         message = f"The greenhouse sensor '{sensorName}' has not sent a signal in {lastCheckinTimeMin:.2f} minutes. Verify it is still within range and the battery is good.\n"
 
-    message += f"This message will repeat in {(timeoutEmailDelayTimeSec/60/60):.2f} hours if it is not resolved.\n"
+    message += f"This message will repeat in {(timeoutEmailDelayTimeSec/60/60):.2f} hours if it is not resolved."
     print(message)
-    message += "\n-The Greenhouse Monitor"
-    status = EmailHandler.send_message("Automatic Greenhouse Timeout Alert", message, rxEmails=None)
-    if status != None:
-        lastTimeoutEmailDict[mac] = time.time()
 
-def handle_tag_data(tagData):
-    recentMacs = list(tagData.keys())
-    config.get_latest_config(recentMacs)
-    for mac in recentMacs:
-        ruuviTagDataHandler.setdefault(mac, DataHandler(mac, emailAlertTimeoutHr))
+    def on_sent(status):
+        if status != None:
+            lastTimeoutEmailDict[mac] = time.time()
+            TimeoutMonitor.alert_sent(mac, lastTimeoutEmailDict[mac])
+    EmailHandler.queue_message("Automatic Greenhouse Timeout Alert", message, rxEmails=None, onSent=on_sent)
 
-    for mac, cfg in config.tagConfigs.items():
-        if not cfg.enabled:
+TimeoutMonitor.onTimeout = send_timeout_alert
+
+#dueMacs are the tags to log this time (Every tag if None). Config sync is skipped on fast ticks, see Scheduler.
+async def handle_tag_data(tagData, dueMacs:list[str] = None, syncConfig:bool = True):
+    now = time.time()
+    if syncConfig:
+        recentMacs = list(set(tagData) | set(ruuvi.latestTagData)) #Not only the due tags, so new tags still get added to the config
+        try:
+            with Metrics.timer("config_sync_seconds"):
+                await config.get_latest_config(recentMacs)
+        except Exception as e:
+            #Carry on with the config we already have, the rows still need to make it into the outbox.
+            Log.log(f"Unable to sync the config: {str(e)}")
+    for mac in config.tagConfigs: #Includes the recent macs, and any tags only added online so they can alert right away
+        if mac not in ruuviTagDataHandler:
+            ruuviTagDataHandler[mac] = DataHandler(mac, emailAlertTimeoutHr)
+        if config.tagConfigs[mac].enabled:
+            TimeoutMonitor.track(mac)
+            Scheduler.track(mac, now)
+
+    for mac in (config.tagConfigs if dueMacs == None else dueMacs):
+        cfg = config.tagConfigs.get(mac)
+        if cfg == None or not cfg.enabled:
+            Scheduler.forget(mac)
             continue
+        Scheduler.reschedule(mac, tagData.get(mac), cfg, now)
         if mac not in tagData:
             print(f"{cfg.name}({mac}) did not collect data")
             continue
-        ruuviTagDataHandler[mac].handle_data(tagData[mac], cfg)
+        for timestamp, append in await ruuviTagDataHandler[mac].handle_data(tagData[mac], cfg):
+            Outbox.enqueue(append, timestamp)
 
-async def check_tag_timeout():
-    for mac, cfg in config.tagConfigs.items():
-        if not cfg.enabled:
-            continue
+    await upload_if_due()
+
+#An outage only holds up uploading. Logging carries on on schedule (The rows wait in the outbox), so this backs off on its own.
+async def upload_if_due():
+    global nextUploadTime, uploadFailures
+    if time.time() < nextUploadTime:
+        return
+    try:
+        with Metrics.timer("upload_outbox_seconds"):
+            await upload_outbox()
+    except Exception as e:
+        retrySec = min(uploadRetryDelaySec * 2 ** uploadFailures, uploadRetryMaxSec)
+        uploadFailures += 1
+        nextUploadTime = time.time() + retrySec
+        Log.log(f"{str(e)} Trying again in {retrySec / 60:.0f} minutes.")
+        return
+    uploadFailures = 0
+    nextUploadTime = 0.0
+    await SheetPartitions.prepare_next_partitions()
 
-        neverCheckedIn = False
+#Sends everything waiting in the outbox, this is normally just this cycle's rows unless we are catching up from an outage.
+async def upload_outbox():
+    while True:
+        pending = Outbox.get_pending()
+        if not pending:
+            return
 
-        lastCheckin = await(ruuvi.minutes_since_last_checkin(mac))
-        if lastCheckin == None:
-            neverCheckedIn = True
-            lastCheckin = (time.time() - programStartTime)/60
+        failures = 0
+        results = await GAPIAsync.batch_append_to_sheets_make_if_dne({fileName: append for fileName, (append, _) in pending.items()})
+        for fileName, result in results.items():
+            if isinstance(result, Exception):
+                failures += 1
+                Log.log(f"{fileName} upload failed: {str(result)}")
+            else:
+                Outbox.mark_uploaded(fileName, pending[fileName][1])
+                SheetPartitions.record_file_id(fileName, result)
 
-        if lastCheckin > tagTimeoutTimeMin:
-            send_timeout_alert(mac, lastCheckin, cfg.name, neverCheckedIn)
+        if failures == len(results):
+            raise(Exception(f"All {failures} sheet uploads failed this cycle. {Outbox.pending_count()} rows are waiting in the outbox."))
+        if failures:
+            return #Leave the rest for next cycle
 
 async def main():
-    #TODO: need to find a way to gracefully stop this task while it is stuck waiting for the generator
-    task = asyncio.create_task(ruuvi.polltags([]))
+    task = asyncio.create_task(ruuvi.polltags([])) #Restarts the scanner itself if it stalls, and stops it when cancelled
     asyncio.gather(task) #Let's us see exceptions instead of it failing silently. (Does not stop anything yet)
+    tokenTask = asyncio.create_task(GAPIAsync.keep_token_fresh()) #Google sign in happens alongside polling instead of before it
+    asyncio.gather(tokenTask)
+    alertTask = asyncio.create_task(AlertMonitor.send_alerts())
+    asyncio.gather(alertTask)
+    for mac, cfg in config.tagConfigs.items():
+        if cfg.enabled:
+            TimeoutMonitor.track(mac)
+            Scheduler.track(mac, time.time())
+    timeoutTask = asyncio.create_task(TimeoutMonitor.watch_timeouts())
+    asyncio.gather(timeoutTask)
+    metricsTasks = [asyncio.create_task(Metrics.monitor_loop_lag()), asyncio.create_task(Metrics.write_stats_periodically())]
+    asyncio.gather(*metricsTasks)
+    if queryServerPort != None:
+        try:
+            await QueryServer.start(queryServerHost, queryServerPort)
+        except Exception as e:
+            Log.log(f"Unable to start the query server: {str(e)}")
     nextErrorLogUpload = time.time() + uploadErrorLogIntervalSec
 
     failcount = 0
     while True:
-        #Get latest tag data at the start of every 10th minute (Based on system clock)
-        timeDiff = pollEvery_thMinute*60 - int(time.time()) % (pollEvery_thMinute*60)
-        print(f"Next poll in {timeDiff/60:.2f}minutes [{timeDiff}seconds]")
-        await asyncio.sleep(timeDiff)
+        #Each tag is logged on its own multiple of the system clock, see Scheduler. Without adaptiveSampling that is the start of every pollEvery_thMinute.
+        wakeTime = Scheduler.next_wakeup(time.time())
+        print(f"Next poll in {(wakeTime - time.time())/60:.2f}minutes [{wakeTime - time.time():.0f}seconds]")
+        await Scheduler.sleep_until(wakeTime)
+        now = time.time()
+        dueMacs = Scheduler.due_macs(now)
+        syncConfig = Scheduler.slow_tick_due(now)
+        if not dueMacs and not syncConfig:
+            continue
 
         try:
-            tagData = await ruuvi.getLatestData()
-            handle_tag_data(tagData)
-            await check_tag_timeout()
+            tagData = await ruuvi.getLatestData(dueMacs)
+            with Metrics.timer("handle_tag_data_seconds"):
+                await handle_tag_data(tagData, dueMacs, syncConfig) #Every due tag goes up in the same batch
             failcount = 0
         except Exception as e:
             failcount += 1
             Log.log(str(e))
+        HistoryWriter.flush_if_due()
 
-        #Bit of backoff. Don't ever want to terminate the program, but don't want to be spamming the network
+        #Bit of backoff for failures here, uploads back off on their own (upload_if_due). Don't ever want to terminate the program.
         if failcount > 1:
             await asyncio.sleep(60 * 10 * min(failcount, 6))
 
         try:
             if time.time() > nextErrorLogUpload:
-                if Log.push_log_to_drive():
+                if await Log.push_log_to_drive():
                     nextErrorLogUpload = time.time() + uploadErrorLogIntervalSec
         except Exception as e:
             Log.log(str(e))
 
 
 
+#Readings Compression is holding back go into the CSVs and outbox so they are uploaded next start
+def flush_held_readings():
+    for mac, handler in ruuviTagDataHandler.items():
+        cfg = config.tagConfigs.get(mac)
+        if cfg == None or not cfg.enabled:
+            continue
+        try:
+            for timestamp, append in handler.flush_held(cfg):
+                Outbox.enqueue(append, timestamp)
+        except Exception as e:
+            Log.log(f"Unable to flush the held reading of {mac}: {str(e)}")
+    if Compression.method != None and Compression.rowsIn:
+        Log.log(f"Compression kept {Compression.rowsKept} of {Compression.rowsIn} readings ({Compression.rowsIn / max(Compression.rowsKept, 1):.1f}:1)")
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if multiProcess:
+        import MultiProcess
+        MultiProcess.supervise() #Runs this file's main() again in the worker process
+    else:
+        try:
+            asyncio.run(main())
+        finally:
+            flush_held_readings()
+            HistoryWriter.close() #SIGTERM lands here too, don't lose the buffered rows
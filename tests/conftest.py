@@ -0,0 +1,5 @@
+import os
+import sys
+
+#The modules live flat in the repository root, next to main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
@@ -0,0 +1,48 @@
+import random
+
+import pytest
+
+import Compression
+from Compression import RowCompressor
+
+@pytest.fixture(autouse=True)
+def swinging_door(monkeypatch):
+    monkeypatch.setattr(Compression, "method", "swinging_door")
+    monkeypatch.setattr(Compression, "heartbeatSec", 10 ** 9)
+    monkeypatch.setattr(Compression, "tolerances", {"temperature": 1.0})
+
+def compress(series):
+    compressor = RowCompressor()
+    kept = []
+    for timestamp, value in series:
+        kept += compressor.add(timestamp, {"temperature": value})
+    kept += compressor.flush()
+    return [(timestamp, fields["temperature"]) for timestamp, fields in kept]
+
+#Joins the kept rows with straight lines and returns how far the worst dropped row is from its line
+def max_rebuild_error(series, kept):
+    worst = 0.0
+    for timestamp, value in series:
+        for (startTime, startValue), (endTime, endValue) in zip(kept, kept[1:]):
+            if startTime <= timestamp <= endTime:
+                rebuilt = startValue + (endValue - startValue) * (timestamp - startTime) / (endTime - startTime)
+                worst = max(worst, abs(rebuilt - value))
+                break
+    return worst
+
+def test_line_to_held_row_must_stay_inside_door():
+    series = [(0, 0.0), (1, 1.0), (2, -0.8), (3, 5.0)]
+    kept = compress(series)
+    assert max_rebuild_error(series, kept) <= 1.0
+    assert kept[0] == (0, 0.0) and kept[-1] == (3, 5.0)
+
+def test_rebuilt_series_stays_within_tolerance():
+    generator = random.Random(1)
+    value = 20.0
+    series = []
+    for timestamp in range(0, 20000, 10):
+        value += generator.gauss(0, 0.3)
+        series.append((timestamp, value))
+    kept = compress(series)
+    assert len(kept) < len(series) / 2
+    assert max_rebuild_error(series, kept) <= 1.0 + 1e-9
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("bleak")
+pytest.importorskip("ruuvitag_sensor")
+pytest.importorskip("googleapiclient")
+
+import RuuviPoller as ruuvi
+import ScannerSupervisor
+
+class FakeScanner:
+    started = 0
+    stopped = 0
+    stopping = False
+    stopDelaySec = 0
+
+    def __init__(self, onDetection, adapter):
+        self.onDetection = onDetection
+
+    async def start(self):
+        FakeScanner.started += 1
+
+    async def stop(self):
+        FakeScanner.stopping = True
+        await asyncio.sleep(FakeScanner.stopDelaySec)
+        FakeScanner.stopped += 1
+        FakeScanner.stopping = False
+
+@pytest.fixture
+def fake_scanner(monkeypatch):
+    FakeScanner.started = 0
+    FakeScanner.stopped = 0
+    FakeScanner.stopping = False
+    FakeScanner.stopDelaySec = 0
+    monkeypatch.setattr(ruuvi, "make_scanner", FakeScanner)
+    monkeypatch.setattr(ScannerSupervisor, "stallSec", 0.2)
+    monkeypatch.setattr(ScannerSupervisor, "minRestartDelaySec", 0.01)
+    monkeypatch.setattr(ruuvi, "log", lambda message: None)
+    monkeypatch.setattr(ScannerSupervisor, "log", lambda message: None)
+    return FakeScanner
+
+async def ignore(mac, data):
+    pass
+
+def test_stalled_scanners_are_stopped_on_restart_and_cancel(fake_scanner):
+    supervisor = ScannerSupervisor.ScannerSupervisor("test")
+
+    async def run():
+        task = asyncio.create_task(supervisor.run(lambda: ruuvi.scan_tags([]), ignore))
+        while supervisor.restarts < 2:
+            await asyncio.sleep(0.05)
+        assert fake_scanner.started - fake_scanner.stopped <= 1 #Never more than the current one
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+    assert fake_scanner.started >= 2
+    assert fake_scanner.stopped == fake_scanner.started
+
+def test_cancelled_while_waiting_stops_scanner(fake_scanner):
+    async def run():
+        async def consume():
+            async for _ in ruuvi.scan_tags([]):
+                pass
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+    assert fake_scanner.started == 1
+    assert fake_scanner.stopped == 1
+
+def test_cancelled_during_teardown_stops_supervisor(fake_scanner):
+    fake_scanner.stopDelaySec = 0.5
+    supervisor = ScannerSupervisor.ScannerSupervisor("test")
+
+    async def run():
+        task = asyncio.create_task(supervisor.run(lambda: ruuvi.scan_tags([]), ignore))
+        while not fake_scanner.stopping:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.wait_for(asyncio.gather(task, return_exceptions=True), 3)
+        assert task.cancelled()
+
+    asyncio.run(run())
+    assert fake_scanner.started == 1
+    assert fake_scanner.stopped == 1